@@ -1,11 +1,9 @@
-from fastapi import APIRouter, Request, BackgroundTasks
+from fastapi import APIRouter, Request
 from api.utils.authTools import AuthenticationTools
 from api.utils.notificationTools import NotificationTools
 from api.decorators.auth import authRequired
 import api.errors.exceptions as exceptions
 from utils.systemTools import SystemTools
-from utils.queueTools import QueueTools
-from main import logger
 import croniter
 import datetime
 import pytz
@@ -16,7 +14,6 @@ router = APIRouter()
 authTools = AuthenticationTools()
 notificationTools = NotificationTools()
 systemTools = SystemTools()
-queueTools = QueueTools(logger)
 
 @router.get("/v2/helpers")
 @authRequired
@@ -36,7 +33,7 @@ async def getAvailableHelpers(request: Request):
 
 @router.post("/v2/helpers")
 @authRequired
-async def registerHelper(request: Request, backgroundTasks: BackgroundTasks):
+async def registerHelper(request: Request):
 
     try:
         json = await request.json()
@@ -114,12 +111,11 @@ async def registerHelper(request: Request, backgroundTasks: BackgroundTasks):
     request.state.user["services"].append(helperData)
     await authTools.update_user(request.state.user["id"], request.state.user)
     
-    backgroundTasks.add_task(queueTools.update_queue_for_user, user_id=request.state.user["id"])
     return {"success": True, "message": "Helper registered successfully!", "helper": helperData}
 
 @router.delete("/v2/helpers/{helperId}")
 @authRequired
-async def unregisterHelper(request: Request, helperId: str, backgroundTasks: BackgroundTasks):
+async def unregisterHelper(request: Request, helperId: str):
     registeredHelper = await systemTools.get_registered_helper(helperId)
     if not registeredHelper:
         raise exceptions.NotFound("This helper does not exist", "helper_not_found")
@@ -137,14 +133,13 @@ async def unregisterHelper(request: Request, helperId: str, backgroundTasks: Bac
     request.state.user["services"] = [service for service in request.state.user["services"] if service["id"] != helperId]
 
     await authTools.update_user(request.state.user["id"], request.state.user)
-    backgroundTasks.add_task(queueTools.update_queue_for_user, user_id=request.state.user["id"])
 
     return {"success": True, "message": "Helper unregistered successfully!"}
 
 
 @router.put("/v2/helpers/{helperId}")
 @authRequired
-async def updateHelper(request: Request, helperId: str, backgroundTasks: BackgroundTasks):
+async def updateHelper(request: Request, helperId: str):
     try:
         json = await request.json()
     except:
@@ -213,7 +208,6 @@ async def updateHelper(request: Request, helperId: str, backgroundTasks: Backgro
         helperInUser["enabled"] = json["enabled"]
 
     await authTools.update_user(request.state.user["id"], request.state.user)    
-    backgroundTasks.add_task(queueTools.update_queue_for_user, user_id=request.state.user["id"])
 
     return {"success": True, "message": "Helper updated successfully!", "helper": helperInUser}    
     
\ No newline at end of file
@@ -1,5 +1,5 @@
 from utils.mongoHandler import MongoHandler
-from api.utils.redis import redisClient
+from api.utils.redis import redisClient, SCHEDULING_CHANGES_STREAM
 import api.errors.exceptions as exceptions
 from passlib.context import CryptContext
 import uuid
@@ -9,6 +9,8 @@ import jwt
 import datetime
 
 db = MongoHandler().db
+# user fields the queue schedules from
+SCHEDULING_FIELDS = ("services", "region", "status", "admin")
 pwdContext = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 
@@ -66,6 +68,23 @@ class AuthenticationTools:
             user.pop("_id", None)
             return user
 
+    async def get_users_by_ids(self, userIds: list) -> dict:
+        # one MGET for the cached users and one query for the rest, instead of a round trip per user
+        if not userIds:
+            return {}
+        users = {}
+        for userId, cachedUser in zip(userIds, await redisClient.mget([f"userData:{userId}" for userId in userIds])):
+            if cachedUser:
+                users[userId] = json.loads(cachedUser)
+
+        missingIds = [userId for userId in userIds if userId not in users]
+        if missingIds:
+            for user in db.users.find({"id": {"$in": missingIds}}):
+                user.pop("_id", None)
+                user.pop("passwordHash", None)
+                users[user["id"]] = user
+        return users
+
     async def get_user_by_username(self, username: str, bypassCache: bool = False, raw: bool = False) -> dict:
         if not bypassCache:
             lookupId = await redisClient.get(f"lookup.users.byUsername:{username}")
@@ -98,6 +117,7 @@ class AuthenticationTools:
     async def delete_user(self, user: str) -> None:
         db.users.delete_one({"id": user["id"]})
         await redisClient.delete(f"userData:{user["id"]}")
+        await self.publish_user_change(user["id"])
         
         lookupByEmail = await redisClient.get(f"lookup.users.byEmail:{user["email"]}")
         if lookupByEmail:
@@ -108,12 +128,19 @@ class AuthenticationTools:
             await redisClient.delete(f"lookup.users.byUsername:{user["username"]}")
     
     async def update_user(self, userId, data: dict) -> None:
+        previousUser = await self.get_user_by_id(userId)
         await self.delete_user_cache(userId)
         data["updatedAt"] = str(datetime.datetime.now(datetime.timezone.utc))
         db.users.update_one({"id": userId}, {"$set": data})
         await redisClient.set(f"userData:{userId}", json.dumps(data), ex=18000)
         await redisClient.set(f"lookup.users.byEmail:{data["email"]}", userId, ex=18000)
         await redisClient.set(f"lookup.users.byUsername:{data["username"]}", userId, ex=18000) 
+        # every change rebuilds the user's queued jobs, so updates that can't affect scheduling (e.g. device check-ins) aren't published
+        if not previousUser or any(field in data and data[field] != previousUser.get(field) for field in SCHEDULING_FIELDS):
+            await self.publish_user_change(userId)
+
+    async def publish_user_change(self, userId: str) -> None:
+        await redisClient.xadd(SCHEDULING_CHANGES_STREAM, {"userId": userId}, maxlen=10000, approximate=True)
     
     async def delete_user_cache(self, userId: str) -> None:
         user = await self.get_user_by_id(userId)
@@ -155,6 +182,14 @@ class AuthenticationTools:
         
         return users
     
+    async def get_active_users_with_services(self, serviceIds: list) -> list:
+        users = list(db.users.find({"status": "active", "services": {"$elemMatch": {"id": {"$in": serviceIds}, "enabled": True}}}))
+        for user in users:
+            user.pop("_id", None)
+            user.pop("passwordHash", None)
+        
+        return users
+    
     async def block_user(self, userId: str, reason: str) -> dict:
         user = await self.get_user_by_id(userId)
         if not user:
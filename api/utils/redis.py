@@ -2,3 +2,6 @@ import redis.asyncio as redis
 import os
 
 redisClient = redis.from_url(os.environ.get("REDIS_URL"), decode_responses=True)
+
+# user and helper changes that need rescheduling, consumed by the realtime queue updater
+SCHEDULING_CHANGES_STREAM = "schedulingChanges"
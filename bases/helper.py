@@ -1,3 +1,10 @@
+class HelperDeferred(Exception):
+    # raised from run() to run the job again in `delay` seconds, instead of holding a slot while it waits
+    def __init__(self, delay: int):
+        super().__init__(delay)
+        self.delay = delay
+
+
 class BaseHelper:
     def __init__(
             self,
@@ -11,7 +18,11 @@ class BaseHelper:
             require_admin_activation: bool = False, # this helper can only be activated by an admin. This does not mean that only admins can run it.
             boot_run: bool = False, # run at startup
             priority: int = 5, # priority for scheduling, from 5 (highest) to 1 (lowest)
-            timeout: int = 100, # the maxium time in seconds this helper can run before being considered expired
+            timeout: int = 100, # the maxium time in seconds this helper can run before being cancelled
+            execution_expiry: int = None, # how many seconds a queued run may start late before it is considered expired (defaults to the timeout)
+            max_concurrency: int = None, # max instances of this helper running at once (defaults to a share of the executor based on priority)
+            max_attempts: int = None, # times a failing run is attempted before it is dead-lettered (defaults to JOB_MAX_ATTEMPTS)
+            execution_mode: str = "async", # where run() executes: "async" (event loop), "thread" (for blocking I/O) or "process" (for CPU-heavy work)
             allow_execution_time_config: bool = True, # can the user configure the execution time of this helper
             disabled: bool = False, # disable the helper entirely
             schedule: list = [], # helper running schedule (only required if allow_execution_time_config is False)
@@ -28,6 +39,10 @@ class BaseHelper:
         self.boot_run = boot_run
         self.priority = priority
         self.timeout = timeout
+        self.execution_expiry = execution_expiry
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.execution_mode = execution_mode
         self.allow_execution_time_config = allow_execution_time_config
         self.disabled = disabled
         self.schedule = schedule
@@ -0,0 +1,56 @@
+# per-job dispatch overhead: resolving a helper class, constructing it and handing it to the executor.
+# run with `python -m benchmarks.dispatch [iterations]`. REDIS_URL must be set, but redis itself is never used
+import asyncio
+import sys
+import time
+import timeit
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from bases.helper import BaseHelper
+from utils.systemTools import SystemTools
+
+systemTools = SystemTools()
+userData = {"id": "benchmark", "services": []}
+
+
+class benchHelper(BaseHelper):
+    def __init__(self, **kwargs):
+        super().__init__(id="benchHelper", name="Benchmark Helper", priority=5, timeout=None, **kwargs)
+
+    async def run(self):
+        return None
+
+
+def import_lookup():
+    # what run_helper used to do for every job
+    helperModule = __import__(__name__, fromlist=["benchHelper"])
+    return getattr(helperModule, "benchHelper")(user=userData)
+
+
+def factory_lookup():
+    return systemTools.create_helper("benchHelper", userData)
+
+
+async def dispatch(jobs: int):
+    futures = [await systemTools.run_helper("benchHelper", userData) for _ in range(jobs)]
+    await asyncio.gather(*futures)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    systemTools.register_helper_class("benchHelper", benchHelper)
+
+    for name, lookup in (("import + getattr", import_lookup), ("class factory", factory_lookup)):
+        seconds = min(timeit.repeat(lookup, number=iterations, repeat=5))
+        print(f"{name:>22}: {seconds / iterations * 1e6:.2f} µs/job")
+
+    jobs = max(1, iterations // 10)
+    startedAt = time.perf_counter()
+    asyncio.run(dispatch(jobs))
+    print(f"{'run_helper + executor':>22}: {(time.perf_counter() - startedAt) / jobs * 1e6:.2f} µs/job ({jobs} jobs)")
+
+
+if __name__ == "__main__":
+    main()
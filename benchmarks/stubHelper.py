@@ -0,0 +1,37 @@
+# the helper benchmarks/workers.py runs. it is copied into helpers/ of the tree the workers are started from,
+# and records the start and the outcome of every run so the benchmark can check each job ran as often as it should
+import asyncio
+import os
+import random
+from bases.helper import BaseHelper
+from api.utils.redis import redisClient
+
+FAIL_RATE = 0.1
+
+
+class benchmarkStub(BaseHelper):
+    def __init__(self, **kwargs):
+        super().__init__(
+            id="benchmarkStub",
+            name="Benchmark Stub",
+            description="Records its runs for benchmarks/workers.py",
+            internal=True,
+            priority=3,
+            timeout=30,
+            # low enough that the executor's per-helper cap (and what a claim takes because of it) is exercised too
+            max_concurrency=5,
+            allow_execution_time_config=False,
+            region_lock=["*"],
+            **kwargs,
+        )
+
+    async def run(self):
+        run = f"{self.user['id']}|{os.environ['WORKER_ID']}"
+        firstRun = await redisClient.hincrby("benchmark:starts", self.user["id"], 1) == 1
+        await redisClient.rpush("benchmark:runs", f"{run}|start")
+        await asyncio.sleep(random.uniform(0.05, 0.3))
+        # only first runs fail, so nothing runs out of attempts
+        if firstRun and random.random() < FAIL_RATE:
+            await redisClient.rpush("benchmark:runs", f"{run}|fail")
+            raise RuntimeError("injected failure")
+        await redisClient.rpush("benchmark:runs", f"{run}|ok")
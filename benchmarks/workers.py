@@ -0,0 +1,183 @@
+# multi-process check of the shipped dispatcher: real `HELPERS_MODE=worker python main.py` processes claim, run, renew,
+# re-queue, retry and complete jobs of a stub helper (benchmarks/stubHelper.py) against a real redis.
+# run with `python -m benchmarks.workers [workers] [jobs]`. it CLEARS the execution queue, so point REDIS_URL at a throwaway redis.
+# one worker is killed (SIGKILL) mid-run and one is stopped (SIGTERM) mid-run, their jobs have to be finished by the others.
+# passes when every job completes, none completes twice, every extra run is explained by a failure or an interrupted worker,
+# the stopped workers drain and exit cleanly and nothing is left running or queued
+import asyncio
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HELPER_ID = "benchmarkStub"
+# short leases and retries, so the killed worker's jobs and the injected failures come back within seconds
+WORKER_ENV = {
+    "HELPERS_MODE": "worker",
+    "HELPERS_HOT_RELOAD": "false",
+    "DB_ENV": "benchmark",
+    "JOB_LEASE_SECONDS": "3",
+    "JOB_RETRY_BASE_SECONDS": "1",
+    "JOB_RETRY_MAX_SECONDS": "2",
+    "SHUTDOWN_GRACE_SECONDS": "1",
+}
+BOOT_TIMEOUT = 60
+RUN_TIMEOUT = 120
+
+
+def build_tree():
+    # workers discover helpers from ./helpers, so they run from a copy of the tree with the stub helper added.
+    # their logs and helper manifest stay in the copy too
+    tree = tempfile.mkdtemp(prefix="helpers-benchmark-")
+    shutil.copytree(REPO_ROOT, tree, dirs_exist_ok=True, ignore=shutil.ignore_patterns(".git", "__pycache__", "logs", "helperManifest.json*", ".venv", "venv"))
+    shutil.copy(os.path.join(REPO_ROOT, "benchmarks", "stubHelper.py"), os.path.join(tree, "helpers", f"{HELPER_ID}.py"))
+    return tree
+
+
+def start_worker(tree: str, workerId: str):
+    env = {**os.environ, "WORKER_ID": workerId}
+    logFile = open(os.path.join(tree, f"{workerId}.log"), "w")
+    return subprocess.Popen([sys.executable, "main.py"], cwd=tree, env=env, stdout=logFile, stderr=subprocess.STDOUT)
+
+
+async def wait_for_run(redisClient, workerId: str, timeout: float):
+    # until the worker started running a job, so it is interrupted while it holds leases
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if any(entry.split("|")[1] == workerId for entry in await redisClient.lrange("benchmark:runs", 0, -1)):
+            return True
+        await asyncio.sleep(0.01)
+    return False
+
+
+async def check(tree: str, workerCount: int, jobCount: int):
+    # imported from the copy, so this process and the workers run the same code
+    from api.utils.redis import redisClient
+    from utils.logger import logger
+    from utils.queueTools import QueueTools
+
+    queueTools = QueueTools(logger)
+    await queueTools.clear_queue()
+    userIds = [f"benchmarkUser{i}" for i in range(jobCount)]
+    await redisClient.delete("benchmark:runs", "benchmark:starts", "runningJobsByUser", "runningJobsByHelper", "quotaWaitingUsers", "quotaWaitingHelpers")
+    # the dispatcher reads users through the user cache, so no database is needed
+    await redisClient.mset({f"userData:{userId}": json.dumps({"id": userId, "services": []}) for userId in userIds})
+
+    currentTime = int(time.time())
+    jobs = [queueTools.build_job(HELPER_ID, userId, currentTime - 1, 3, 3600) for userId in userIds]
+    await queueTools.queue_jobs(jobs)
+    jobIds = {job["executionId"]: job["userId"] for job in jobs}
+
+    workerIds = [f"benchmark-{i}" for i in range(workerCount)]
+    killedWorker, stoppedWorker = workerIds[0], workerIds[1]
+    startedAt = time.perf_counter()
+    workers = {workerId: start_worker(tree, workerId) for workerId in workerIds}
+    problems = []
+    try:
+        if not await wait_for_run(redisClient, killedWorker, BOOT_TIMEOUT):
+            raise RuntimeError(f"{killedWorker} never ran a job, see its log in {tree}")
+        workers[killedWorker].send_signal(signal.SIGKILL)
+        if not await wait_for_run(redisClient, stoppedWorker, BOOT_TIMEOUT):
+            raise RuntimeError(f"{stoppedWorker} never ran a job, see its log in {tree}")
+        workers[stoppedWorker].send_signal(signal.SIGTERM)
+
+        deadline = time.time() + RUN_TIMEOUT
+        while time.time() < deadline:
+            async with redisClient.pipeline(transaction=False) as pipe:
+                for jobId in jobIds:
+                    pipe.hmget(f"executionJob:{jobId}", "status", "attempts")
+                jobStates = await pipe.execute()
+            if all(status == "completed" for status, _ in jobStates):
+                break
+            await asyncio.sleep(0.5)
+        elapsed = time.perf_counter() - startedAt
+    finally:
+        for workerId, worker in workers.items():
+            if worker.poll() is None:
+                worker.send_signal(signal.SIGTERM)
+        for workerId, worker in workers.items():
+            try:
+                worker.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+                problems.append(f"{workerId} didn't shut down within 30s")
+
+    for workerId, worker in workers.items():
+        if workerId != killedWorker and worker.returncode != 0:
+            problems.append(f"{workerId} exited with code {worker.returncode}")
+        if workerId != killedWorker and await redisClient.exists(f"dispatcherWorker:{workerId}"):
+            problems.append(f"{workerId} left its heartbeat key behind")
+
+    # per job: runs started, outcomes, and how many of them were on the killed or stopped worker
+    interrupted = (killedWorker, stoppedWorker)
+    starts, oks, fails, interruptedStarts = {}, {}, {}, {}
+    for entry in await redisClient.lrange("benchmark:runs", 0, -1):
+        userId, workerId, event = entry.split("|")
+        if event == "start":
+            starts[userId] = starts.get(userId, 0) + 1
+            if workerId in interrupted:
+                interruptedStarts[userId] = interruptedStarts.get(userId, 0) + 1
+        elif event == "ok":
+            oks.setdefault(userId, []).append(workerId)
+        else:
+            fails.setdefault(userId, []).append(workerId)
+
+    failedAttempts = 0
+    for (jobId, userId), (status, attempts) in zip(jobIds.items(), jobStates):
+        attempts = int(attempts or 0)
+        failedAttempts += attempts
+        finishedBy = oks.get(userId, [])
+        # a run that finished but was interrupted before its job was completed runs again
+        extraRuns = starts.get(userId, 0) - attempts - 1
+        if status != "completed":
+            problems.append(f"{jobId} was lost (status {status})")
+        elif not finishedBy:
+            problems.append(f"{jobId} completed without a successful run")
+        elif len([workerId for workerId in finishedBy if workerId not in interrupted]) > 1:
+            problems.append(f"{jobId} completed {len(finishedBy)} times ({', '.join(finishedBy)})")
+        elif not 0 <= extraRuns <= interruptedStarts.get(userId, 0):
+            problems.append(f"{jobId} ran {starts.get(userId, 0)} times with {attempts} failed attempts")
+
+    leftovers = await redisClient.zcard("runningJobs") + await redisClient.zcard(queueTools.queue_key("global"))
+    if leftovers:
+        problems.append(f"{leftovers} jobs left running or queued")
+    for key in ("runningJobsByUser", "runningJobsByHelper"):
+        if await redisClient.hlen(key):
+            problems.append(f"{key} still counts running jobs: {await redisClient.hgetall(key)}")
+
+    print(f"{jobCount} jobs, {workerCount} workers (1 killed, 1 stopped) in {elapsed:.2f}s")
+    print(f"{sum(starts.values())} runs: {failedAttempts} failed and retried, {sum(interruptedStarts.values())} on the interrupted workers")
+    await queueTools.clear_queue()
+    await redisClient.delete("benchmark:runs", "benchmark:starts", *(f"userData:{userId}" for userId in userIds))
+    for problem in problems[:20]:
+        print(f"FAIL {problem}")
+    print(f"FAIL, worker logs are in {tree}" if problems else "OK: every job completed exactly once")
+    return 1 if problems else 0
+
+
+def main():
+    workerCount = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    jobCount = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    if workerCount < 3:
+        sys.exit("at least 3 workers are needed, one is killed and one is stopped")
+
+    os.environ.update(WORKER_ENV)
+    tree = build_tree()
+    os.chdir(tree)
+    sys.path.insert(0, tree)
+    exitCode = asyncio.run(check(tree, workerCount, jobCount))
+    if not exitCode:
+        shutil.rmtree(tree, ignore_errors=True)
+    return exitCode
+
+
+if __name__ == "__main__":
+    sys.exit(main())
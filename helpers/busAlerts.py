@@ -1,9 +1,9 @@
-from bases.helper import BaseHelper
+from bases.helper import BaseHelper, HelperDeferred
+import asyncio
 import datetime
-from main import logger
+from utils.logger import logger
 from utils.pusher import Pusher
 import requests
-import time
 
 pusher = Pusher()
 
@@ -20,6 +20,8 @@ class busAlerts(BaseHelper):
                 "weekendEnabled": "bool",
             },
             priority=1,
+            # a late alert is useless, so a run that can't start within 2 minutes is dropped
+            execution_expiry=120,
             allow_execution_time_config=True,
             region_lock=["PT"],
             **kwargs,
@@ -33,7 +35,8 @@ class busAlerts(BaseHelper):
             logger.info(f"[busAlerts] Weekend alerts are disabled for user {self.user['id']}. Skipping.")
             return
         
-        carrisArrivalData = requests.get(f"https://api.carrismetropolitana.pt/v2/arrivals/by_stop/{str(busParams['pickupStopId'])}").json()
+        # it waits on the event loop, only the blocking calls go to a thread
+        carrisArrivalData = (await asyncio.to_thread(requests.get, f"https://api.carrismetropolitana.pt/v2/arrivals/by_stop/{str(busParams['pickupStopId'])}", timeout=10)).json()
         if carrisArrivalData == []:
             logger.warn(f"[busAlerts] No data available for stop {busParams['pickupStopId']} for user {self.user['id']}.")
             return
@@ -42,18 +45,23 @@ class busAlerts(BaseHelper):
             if arrival["line_id"] == str(busParams["lineId"]) and arrival["scheduled_arrival"] == busParams["scheduledPickupTime"]:
                 secondsToArrive = arrival["scheduled_arrival_unix"] - int(datetime.datetime.now().timestamp())
                 logger.warn(f"bus time diff: {secondsToArrive}")
-                while True:
-                    if secondsToArrive <= 300:
-                        pusher.push(
-                            sender="Bus Alerts",
-                            recipient=self.user["id"],
-                            title="Your bus is arriving!",
-                            body=f"Your bus (line {str(busParams['lineId'])}) is arriving at your stop at {arrival['scheduled_arrival']}. Get ready!",
-                            data={"customScreenOpen": "busAlerts"},
-                            ttl=100
-                        )
+                if secondsToArrive < 0:
+                    logger.info(f"[busAlerts] Bus for user {self.user['id']} already passed. Skipping.")
+                    return
+                if secondsToArrive > 300:
+                    # the job comes back (with fresh arrival data) when the bus is 5 minutes away, instead of waiting in a slot
+                    raise HelperDeferred(secondsToArrive - 300)
 
-                        logger.info(f"[busAlerts] Pushed notification to user {self.user['id']}!")
-                        break
-                    await time.sleep(5)
+                await asyncio.to_thread(
+                    pusher.push,
+                    sender="Bus Alerts",
+                    recipient=self.user["id"],
+                    title="Your bus is arriving!",
+                    body=f"Your bus (line {str(busParams['lineId'])}) is arriving at your stop at {arrival['scheduled_arrival']}. Get ready!",
+                    data={"customScreenOpen": "busAlerts"},
+                    ttl=100
+                )
+
+                logger.info(f"[busAlerts] Pushed notification to user {self.user['id']}!")
+                return
                 
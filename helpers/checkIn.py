@@ -1,7 +1,7 @@
 from bases.helper import BaseHelper
 import os
 import requests
-from main import logger
+from utils.logger import logger
 
 class checkIn(BaseHelper):
     def __init__(self, **kwargs):
@@ -14,12 +14,13 @@ class checkIn(BaseHelper):
             schedule=["*/2 * * * *"],
             internal=True,
             allow_execution_time_config=False,
+            execution_mode="thread",
             **kwargs,
         )
 
     async def run(self):
         logger.info(f"[checkIn] Started! Sending heartbeat...")
 
-        r = requests.get(os.environ.get("BETTER_STACK_HB"))
+        r = requests.get(os.environ.get("BETTER_STACK_HB"), timeout=10)
 
         logger.info(f"[checkIn] Heartbeat sent! Status code: {r.status_code}")
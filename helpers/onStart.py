@@ -1,6 +1,6 @@
 from bases.helper import BaseHelper
 from utils.github import GitHub
-from main import logger
+from utils.logger import logger
 from utils.pusher import Pusher
 
 gh = GitHub()
@@ -19,6 +19,7 @@ class onStart(BaseHelper):
             allow_execution_time_config=False,
             timeout=100,
             region_lock=["*"],
+            execution_mode="thread",
             **kwargs,
         )
 
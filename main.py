@@ -1,5 +1,11 @@
+import time
+
+# cold start includes importing our dependencies, so the clock starts before them
+importStartedAt = time.perf_counter()
+
 import asyncio
 import os
+import sys
 from dotenv import load_dotenv
 import sentry_sdk
 from sentry_sdk.integrations.logging import LoggingIntegration
@@ -7,17 +13,20 @@ from sentry_sdk.integrations.logging import LoggingIntegration
 load_dotenv()
 
 from utils.startup import Startup
-from utils.logger import Logger
+from utils.logger import logger
 from utils.github import GitHub
 from utils.systemTools import SystemTools
 from utils.queueTools import QueueTools
+from utils.leader import LeaderElection, LeadershipLost
 
 
 systemTools = SystemTools()
-logger = Logger()
 startup = Startup(logger)
 queueTools = QueueTools(logger)
+leader = LeaderElection(logger, startup.workerId)
 gh = GitHub()
+# reloads changed helper files in place instead of requiring a restart (and a queue rebuild)
+hotReload = os.environ.get("HELPERS_HOT_RELOAD", "false").lower() == "true"
 
 if os.environ.get("DB_ENV") == "production":
     sentry_sdk.init(
@@ -37,21 +46,61 @@ if os.environ.get("DB_ENV") == "production":
 global apiProcess
 
 
+async def run_worker():
+    # worker mode only dispatches jobs from the shared queue. the main instance owns the API and the scheduling
+    logger.info(f"[STARTUP] Starting dispatcher worker {startup.workerId}.")
+    # workers don't register helpers, they only need the classes to run them
+    helperClasses = await startup.load_helper_classes()
+    logger.info(f"[STARTUP] Loaded {len(helperClasses)} helper classes.")
+    await startup.record_startup_metrics({"mode": "worker", "bootSeconds": round(time.perf_counter() - importStartedAt, 4)})
+    backgroundTasks = [asyncio.create_task(startup.run_heartbeat())]
+    if hotReload:
+        backgroundTasks.append(asyncio.create_task(startup.watch_helpers(register=False)))
+    return await startup.run_until_shutdown(asyncio.create_task(startup.run_dispatcher()), backgroundTasks)
 
 
 async def main():
     logger.info(f"[STARTUP] Hello! Helpers is booting up!")
     logger.info(f"[STARTUP] You are in {os.environ.get('DB_ENV', 'development')} mode")
-    await systemTools.clear_helpers()
-    logger.info("[STARTUP] Cleared helpers cache on redis.")
-
-    logger.info("[STARTUP] Clearing execution queue...")
-    await queueTools.clear_queue()
-    logger.info("[STARTUP] Cleared execution queue on redis.")
+    startup.install_signal_handlers()
+    if os.environ.get("HELPERS_MODE") == "worker":
+        return await run_worker()
+
+    bootStartedAt = time.perf_counter()
+    importSeconds = round(bootStartedAt - importStartedAt, 4)
+    dispatcherSeconds = None
+    warmRestart = os.environ.get("WARM_RESTART", "false").lower() == "true"
+
+    # only the leader builds and extends the shared schedules, other instances just dispatch and take over if it dies
+    isLeader = await leader.try_acquire()
+    leaderTask = asyncio.create_task(leader.run([queueTools.run_scheduler, lambda token: queueTools.run_compactor()]))
+    if not isLeader:
+        logger.info("[STARTUP] Another instance leads the queue updater. This instance will only dispatch.")
+        leader.ready.set()
+
+    if warmRestart:
+        logger.info("[STARTUP] Warm restart enabled. Keeping the persisted execution queue.")
+    elif isLeader:
+        await systemTools.clear_helpers()
+        logger.info("[STARTUP] Cleared helpers cache on redis.")
+
+        logger.info("[STARTUP] Clearing execution queue...")
+        await queueTools.clear_queue()
+        logger.info("[STARTUP] Cleared execution queue on redis.")
 
     loadedHelpers = await startup.discover_helpers()
     logger.info(f"[STARTUP] Found {len(loadedHelpers)} helpers.")
 
+    dispatcherTask = None
+    if warmRestart and isLeader:
+        await queueTools.reconcile_queue(loadedHelpers, startup.workerId)
+        await queueTools.rebalance_shards()
+    if warmRestart or not isLeader:
+        # the queue is valid already, so dispatch while boot runs are being queued
+        dispatcherTask = asyncio.create_task(startup.run_dispatcher())
+        dispatcherSeconds = round(time.perf_counter() - importStartedAt, 4)
+        logger.info(f"[STARTUP] Dispatcher enabled {time.perf_counter() - bootStartedAt:.2f}s after boot.")
+
     apiProcess = await asyncio.create_subprocess_exec(
         "python", "-m", "uvicorn", "api.main:app",
         "--host", "0.0.0.0",
@@ -60,31 +109,39 @@ async def main():
         "--limit-concurrency", os.environ.get("API_LIMIT_CONCURRENCY", "500"),
     )
 
+    startup.apiProcess = apiProcess
     logger.info(f"[STARTUP] Launched API process with PID {apiProcess.pid}.")
-    
-    await queueTools.build_initial_execution_queue()
-    logger.info("[STARTUP] Built initial execution queue.")
 
-    try:
-        
-        logger.info(f"[STARTUP] Startup complete. Enabling dispatcher.")
-
-        await asyncio.gather(
-            startup.run_dispatcher(),
-            queueTools.queue_updater_realtime()
-        )
-
-    except KeyboardInterrupt as e:
-        logger.info("[SHUTDOWN] Shutting down.")
-        startup.force_exit(apiProcess)
-    except Exception as e:
-        logger.error("[STARTUP] Shutting down due to internal error", e)
-        startup.force_exit(apiProcess)
-    finally:
-        startup.force_exit(apiProcess)
+    if isLeader:
+        queueTools.fencingToken = leader.token
+        try:
+            if not warmRestart:
+                await queueTools.rebalance_shards()
+            await queueTools.build_initial_execution_queue(warm=warmRestart)
+            logger.info("[STARTUP] Built initial execution queue.")
+        except LeadershipLost as e:
+            logger.warn(f"[STARTUP] Lost the queue updater leadership while building the queue. {e}")
+        leader.ready.set()
+
+    logger.info(f"[STARTUP] Startup complete in {time.perf_counter() - bootStartedAt:.2f}s. Enabling dispatcher.")
+    bootSeconds = round(time.perf_counter() - importStartedAt, 4)
+    await startup.record_startup_metrics({
+        "mode": "leader" if isLeader else "follower",
+        "warmRestart": warmRestart,
+        "importSeconds": importSeconds,
+        "dispatcherSeconds": dispatcherSeconds or bootSeconds,
+        "bootSeconds": bootSeconds,
+    })
+
+    backgroundTasks = [asyncio.create_task(startup.run_heartbeat()), leaderTask]
+    if hotReload:
+        backgroundTasks.append(asyncio.create_task(startup.watch_helpers()))
+
+    # SIGTERM/SIGINT stop claiming, drain in-flight jobs and release the rest back to the queue before exiting
+    return await startup.run_until_shutdown(dispatcherTask or asyncio.create_task(startup.run_dispatcher()), backgroundTasks)
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        sys.exit(asyncio.run(main()))
     except Exception as e:
         logger.error("Something went wrong!", e)
\ No newline at end of file
@@ -0,0 +1,256 @@
+import asyncio
+import importlib
+import itertools
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from bases.helper import HelperDeferred
+
+EXECUTION_MODES = ("async", "thread", "process")
+
+
+class HelperTimeout(Exception):
+    pass
+
+
+class HelperExpired(Exception):
+    pass
+
+
+def mark_started(started: asyncio.Future):
+    if not started.done():
+        started.set_result(None)
+
+
+def run_in_thread(runner, handle: dict):
+    # blocking helpers get their own event loop inside the pool thread.
+    # the loop and task are handed back so a timed out helper can be cancelled from the main loop
+    async def main():
+        handle["loop"] = asyncio.get_running_loop()
+        handle["task"] = asyncio.current_task()
+        handle["mainLoop"].call_soon_threadsafe(mark_started, handle["started"])
+        return await runner()
+    return asyncio.run(main())
+
+
+def run_in_process(moduleName: str, className: str, userData: dict, connection):
+    # runs in a process of its own, the result (or the error) is sent back through the pipe
+    try:
+        helperClass = getattr(importlib.import_module(moduleName), className)
+        connection.send((True, asyncio.run(helperClass(user=userData).run())))
+    except BaseException as e:
+        connection.send((False, e))
+    finally:
+        connection.close()
+
+
+class Executor:
+    def __init__(self):
+        self.maxConcurrency = int(os.environ.get("EXECUTOR_MAX_CONCURRENCY", 50))
+        # claimed jobs beyond the free slots are kept to a small buffer, so due jobs stay in the queue for other workers
+        self.maxWaiting = int(os.environ.get("EXECUTOR_MAX_WAITING", 10))
+        self.threadPoolSize = int(os.environ.get("EXECUTOR_THREAD_POOL_SIZE", 16))
+        self.processPoolSize = int(os.environ.get("EXECUTOR_PROCESS_POOL_SIZE", os.cpu_count() or 1))
+        self.threadPool = None
+        self.processSlots = asyncio.Semaphore(self.processPoolSize)
+        self.waiting = {}  # helperId -> deque of (priority, sequence, helper, future, expires at)
+        self.running = {}  # helperId -> running tasks
+        self.helperLimits = {}  # helperId -> max running tasks
+        self.tasks = set()
+        self.sequence = itertools.count()
+        self.capacityFreed = asyncio.Event()
+
+        self.inFlight = 0
+        self.waitingCount = 0
+        self.completed = 0
+        self.failed = 0
+        self.timedOut = 0
+        self.expired = 0
+        self.deferred = 0
+
+    def helper_limit(self, priority: int, max_concurrency: int = None):
+        # priority 5 helpers may use the whole pool, priority 1 helpers a fifth of it
+        if max_concurrency:
+            return min(max_concurrency, self.maxConcurrency)
+        return max(1, self.maxConcurrency * priority // 5)
+
+    def submit(self, helper, expires_at: float = None):
+        # a run still waiting for a slot at expires_at (unix time) fails with HelperExpired instead of starting late
+        if helper.execution_mode not in EXECUTION_MODES:
+            raise ValueError(f"Unknown execution mode '{helper.execution_mode}' for helper {helper.id}")
+
+        future = asyncio.get_running_loop().create_future()
+        self.helperLimits[helper.id] = self.helper_limit(helper.priority, helper.max_concurrency)
+        self.waiting.setdefault(helper.id, deque()).append((helper.priority, next(self.sequence), helper, future, expires_at))
+        self.waitingCount += 1
+        self._drain()
+        return future
+
+    def available_slots(self):
+        # jobs waiting behind their helper's cap don't wait for a free slot, so they don't hold back other helpers
+        waitingForSlots = sum(len(queue) for helperId, queue in self.waiting.items() if self.running.get(helperId, 0) < self.helperLimits[helperId])
+        return max(0, self.maxConcurrency + self.maxWaiting - self.inFlight - waitingForSlots)
+
+    def helper_room(self):
+        # how many more jobs of each helper fit under its cap, for the helpers this executor has seen
+        return {
+            helperId: max(0, limit - self.running.get(helperId, 0) - len(self.waiting.get(helperId, ())))
+            for helperId, limit in self.helperLimits.items()
+        }
+
+    async def wait_for_capacity(self):
+        while not self.available_slots():
+            self.capacityFreed.clear()
+            await self.capacityFreed.wait()
+
+    def stats(self):
+        return {
+            "inFlight": self.inFlight,
+            "waiting": self.waitingCount,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timedOut": self.timedOut,
+            "expired": self.expired,
+            "deferred": self.deferred,
+            "running": {helperId: count for helperId, count in self.running.items() if count},
+        }
+
+    def _next_runnable(self):
+        # highest priority first, oldest first inside the same priority
+        best = None
+        for helperId, queue in self.waiting.items():
+            if not queue or self.running.get(helperId, 0) >= self.helperLimits.get(helperId, 1):
+                continue
+            priority, sequence = queue[0][0], queue[0][1]
+            if best is None or (-priority, sequence) < best[0]:
+                best = ((-priority, sequence), helperId)
+        return best[1] if best else None
+
+    def _drain(self):
+        while self.inFlight < self.maxConcurrency:
+            helperId = self._next_runnable()
+            if helperId is None:
+                return
+
+            _, _, helper, future, expiresAt = self.waiting[helperId].popleft()
+            self.waitingCount -= 1
+            if expiresAt is not None and time.time() > expiresAt:
+                self.expired += 1
+                if not future.done():
+                    future.set_exception(HelperExpired(f"Helper {helperId} waited past its expiry"))
+                self.capacityFreed.set()
+                continue
+            self.inFlight += 1
+            self.running[helperId] = self.running.get(helperId, 0) + 1
+
+            task = asyncio.create_task(self._run(helperId, helper, future))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def _execute(self, helper, handle: dict):
+        loop = asyncio.get_running_loop()
+        if helper.execution_mode == "thread":
+            if not self.threadPool:
+                self.threadPool = ThreadPoolExecutor(max_workers=self.threadPoolSize, thread_name_prefix="helper")
+            handle["mainLoop"] = loop
+            return loop.run_in_executor(self.threadPool, run_in_thread, helper.run, handle)
+        if helper.execution_mode == "process":
+            return self._run_process(helper, handle)
+        return helper.run()
+
+    async def _run_process(self, helper, handle: dict):
+        # every process helper gets a process of its own, so a runaway one can be killed without failing the others.
+        # the process is forked when the helper starts, so it always runs the helper modules this process has loaded
+        async with self.processSlots:
+            loop = asyncio.get_running_loop()
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=run_in_process, args=(type(helper).__module__, type(helper).__name__, helper.user, sender))
+            process.start()
+            handle["process"] = process
+            sender.close()
+            mark_started(handle["started"])
+
+            # the pipe turns readable once the result arrives or the process dies
+            readable = loop.create_future()
+            loop.add_reader(receiver.fileno(), lambda: readable.done() or readable.set_result(None))
+            try:
+                await readable
+                try:
+                    succeeded, value = receiver.recv()
+                except EOFError:
+                    succeeded, value = False, None
+            finally:
+                loop.remove_reader(receiver.fileno())
+                receiver.close()
+            await asyncio.to_thread(process.join)
+
+        if succeeded:
+            return value
+        raise value or RuntimeError(f"Helper {helper.id} process exited with code {process.exitcode}")
+
+    async def shutdown(self):
+        # cancels whatever is still running or waiting, their jobs are released by the dispatcher
+        for queue in self.waiting.values():
+            for _, _, _, future, _ in queue:
+                future.cancel()
+            queue.clear()
+        self.waitingCount = 0
+        for task in list(self.tasks):
+            task.cancel()
+        if self.tasks:
+            await asyncio.wait(list(self.tasks), timeout=5)
+        if self.threadPool:
+            self.threadPool.shutdown(wait=False, cancel_futures=True)
+
+    def _stop(self, helper, handle: dict):
+        # async helpers are cancelled along with their task
+        if helper.execution_mode == "thread" and "task" in handle:
+            handle["loop"].call_soon_threadsafe(handle["task"].cancel)
+        elif helper.execution_mode == "process" and "process" in handle:
+            handle["process"].kill()
+
+    async def _run(self, helperId: str, helper, future: asyncio.Future):
+        handle = {"started": asyncio.get_running_loop().create_future()}
+        execution = asyncio.ensure_future(self._execute(helper, handle))
+        try:
+            if helper.execution_mode in ("thread", "process"):
+                # the timeout starts once a pool thread or a process picks the helper up, not while it is queued for one
+                await asyncio.wait({execution, handle["started"]}, return_when=asyncio.FIRST_COMPLETED)
+            # asyncio.wait instead of wait_for, so a TimeoutError raised by the helper itself is still a normal failure
+            done, _ = await asyncio.wait({execution}, timeout=helper.timeout or None)
+            if not done:
+                execution.cancel()
+                self._stop(helper, handle)
+                self.timedOut += 1
+                if not future.done():
+                    future.set_exception(HelperTimeout(f"Helper {helperId} ran for more than {helper.timeout}s"))
+                return
+
+            result = execution.result()
+            self.completed += 1
+            if not future.done():
+                future.set_result(result)
+        except asyncio.CancelledError:
+            execution.cancel()
+            self._stop(helper, handle)
+            self.failed += 1
+            future.cancel()
+            raise
+        except HelperDeferred as e:
+            self.deferred += 1
+            if not future.done():
+                future.set_exception(e)
+        except Exception as e:
+            self.failed += 1
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            self.inFlight -= 1
+            self.running[helperId] -= 1
+            self.capacityFreed.set()
+            self._drain()
+
+
+executor = Executor()
@@ -0,0 +1,101 @@
+import asyncio
+import os
+import time
+from api.utils.redis import redisClient
+
+LEADER_KEY = "queueUpdaterLeader"
+
+# the lease value is "<fencing token>:<worker id>". the token only ever grows, so writes made by a
+# leader that lost its lease (e.g. after a long pause) can be told apart from the current leader's
+# KEYS: leader key, token counter. ARGV: value we hold ("" if none), worker id, lease in ms
+ACQUIRE_LEADERSHIP_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if current and current ~= ARGV[1] then
+    return false
+end
+if not current then
+    current = redis.call('INCR', KEYS[2]) .. ':' .. ARGV[2]
+    redis.call('SET', KEYS[1], current, 'PX', ARGV[3])
+    return current
+end
+redis.call('PEXPIRE', KEYS[1], ARGV[3])
+return current
+"""
+
+# KEYS: leader key. ARGV: value we hold
+RELEASE_LEADERSHIP_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+acquireLeadershipScript = redisClient.register_script(ACQUIRE_LEADERSHIP_SCRIPT)
+releaseLeadershipScript = redisClient.register_script(RELEASE_LEADERSHIP_SCRIPT)
+
+
+class LeadershipLost(Exception):
+    pass
+
+
+class LeaderElection:
+    def __init__(self, logger, worker_id: str):
+        self.logger = logger
+        self.workerId = worker_id
+        self.leaseSeconds = int(os.environ.get("LEADER_LEASE_SECONDS", 15))
+        self.token = None
+        self.renewedAt = 0
+        # leader-only tasks wait for this, so boot can finish building the queue first
+        self.ready = asyncio.Event()
+
+    async def try_acquire(self):
+        try:
+            self.token = await acquireLeadershipScript(
+                keys=[LEADER_KEY, f"{LEADER_KEY}:token"],
+                args=[self.token or "", self.workerId, self.leaseSeconds * 1000],
+            )
+            self.renewedAt = time.monotonic()
+        except Exception as e:
+            # without redis we can't know, so we only keep leading until our lease would have run out
+            self.logger.error("[LEADER] Unable to renew leadership", e)
+            if time.monotonic() - self.renewedAt >= self.leaseSeconds:
+                self.token = None
+        return self.token is not None
+
+    async def release(self):
+        if self.token:
+            await releaseLeadershipScript(keys=[LEADER_KEY], args=[self.token])
+            self.token = None
+
+    async def run(self, leader_tasks: list):
+        # keeps the lease while leading and runs leader_tasks (factories taking the fencing token) only while we hold it.
+        # followers poll every third of the lease, so a dead leader is replaced within about 1.3 leases.
+        # a leader task that crashes or returns is restarted, so holding the lease always means someone is scheduling
+        runningTasks = []
+        try:
+            while True:
+                isLeader = await self.try_acquire()
+                if isLeader and not runningTasks and self.ready.is_set():
+                    self.logger.info(f"[LEADER] {self.workerId} is now the queue updater leader (token {self.token}).")
+                    runningTasks = [asyncio.create_task(task(self.token)) for task in leader_tasks]
+                elif isLeader and runningTasks:
+                    for index, task in enumerate(runningTasks):
+                        if task.done():
+                            if not task.cancelled() and task.exception():
+                                self.logger.error("[LEADER] Leader task crashed. Restarting it", task.exception())
+                            else:
+                                self.logger.warn("[LEADER] Leader task stopped. Restarting it.")
+                            runningTasks[index] = asyncio.create_task(leader_tasks[index](self.token))
+                elif not isLeader and runningTasks:
+                    self.logger.warn(f"[LEADER] {self.workerId} lost the queue updater leadership. Stopping leader tasks.")
+                    for task in runningTasks:
+                        task.cancel()
+                    runningTasks = []
+                await asyncio.sleep(self.leaseSeconds / 3)
+        finally:
+            for task in runningTasks:
+                task.cancel()
+            try:
+                await self.release()
+            except Exception as e:
+                self.logger.error("[LEADER] Unable to release leadership", e)
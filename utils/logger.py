@@ -49,8 +49,17 @@ class Logger:
         sentry_sdk.capture_exception(exception)
         self._write_log("ERROR", message=f"{message}: {exception}", color=Fore.RED)
 
+    def close(self):
+        self.log_file.flush()
+        self.log_file.close()
+        sentry_sdk.flush(timeout=5)
+
     def __del__(self):
         try:
             self.log_file.close()
         except Exception:
             pass
+
+
+# shared by the whole process, so helpers can log without importing main
+logger = Logger()
@@ -16,7 +16,7 @@ class Pusher:
                 "ttl": ttl,
                 "sound": sound,
                 "isCritical": isCritical,
-            })
+            }, timeout=10)
             return r.json()
         except:
             return
@@ -34,7 +34,7 @@ class Pusher:
                 "ttl": ttl,
                 "sound": sound,
                 "isCritical": isCritical,
-            })
+            }, timeout=10)
             return r.json()
         except:
             return
@@ -53,6 +53,6 @@ class Pusher:
             "data": data,
             "ttl": ttl,
             "isCritical": isCritical,
-        })
+        }, timeout=10)
 
         return r.json()
@@ -1,25 +1,469 @@
-from api.utils.redis import redisClient
-import uuid
-import croniter
+from api.utils.redis import redisClient, SCHEDULING_CHANGES_STREAM
 import datetime
 import asyncio
-from utils.logger import Logger
+import itertools
+import random
+import time
+import os
 from utils.systemTools import SystemTools
+from utils.leader import LEADER_KEY, LeadershipLost
 from api.utils.authTools import AuthenticationTools
 
 systemTools = SystemTools()
 authTools = AuthenticationTools()
 
+QUEUE_PREFIX = "internalExecutionQueue"
+WAKEUP_CHANNEL = "internalExecutionQueue:wakeup"
+# a scheduling change that keeps failing is skipped after this many attempts, so it can't stall the feed
+CHANGE_MAX_ATTEMPTS = 5
+# dispatchers blocked by a quota recheck at least this often, in case they missed a slot release
+QUOTA_RECHECK_SECONDS = 5
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled", "dead_lettered", "timed_out")
+
+# jobs live in one queue per shard, the shard is stored on the job itself
+QUEUE_KEY_FUNCTION = """
+local function queue_key(shard)
+    return 'internalExecutionQueue:' .. (shard or 'global')
+end
+"""
+
+# terminal jobs keep their hash for a while (with a ttl) and are counted in an hourly summary
+FINALIZE_JOB_FUNCTION = """
+local function finalize_job(jobKey, helperId, status, retention, summaryKey, summaryRetention)
+    redis.call('HSET', jobKey, 'status', status)
+    redis.call('EXPIRE', jobKey, retention)
+    redis.call('HINCRBY', summaryKey, status, 1)
+    if helperId then
+        redis.call('HINCRBY', summaryKey, helperId .. ':' .. status, 1)
+    end
+    redis.call('EXPIRE', summaryKey, summaryRetention)
+end
+"""
+
+# insert-if-absent: a job that is already queued/running/finished is left untouched,
+# only missing or cancelled jobs are (re)created. wakes the dispatchers of the shard if the job became its queue head
+# KEYS: job hash, shard queue, userJobs index, helperJobs index, shards set, all jobs index. ARGV: execution id, score, wakeup channel, shard, fields...
+ENQUEUE_JOB_SCRIPT = """
+local status = redis.call('HGET', KEYS[1], 'status')
+if status and status ~= 'cancelled' then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], unpack(ARGV, 5))
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+redis.call('SADD', KEYS[3], ARGV[1])
+redis.call('SADD', KEYS[4], ARGV[1])
+redis.call('SADD', KEYS[5], ARGV[4])
+redis.call('SADD', KEYS[6], ARGV[1])
+if redis.call('ZRANGE', KEYS[2], 0, 0)[1] == ARGV[1] then
+    redis.call('PUBLISH', ARGV[3], ARGV[4])
+end
+return 1
+"""
+
+# drops jobs from their queue and indexes, queued ones are marked cancelled
+# KEYS: (optional) index set to cancel entirely. ARGV: retention, summary key, summary retention, execution ids...
+CANCEL_JOBS_SCRIPT = QUEUE_KEY_FUNCTION + FINALIZE_JOB_FUNCTION + """
+local ids = {unpack(ARGV, 4)}
+if #ids == 0 and KEYS[1] then
+    ids = redis.call('SMEMBERS', KEYS[1])
+end
+local cancelled = 0
+for _, executionId in ipairs(ids) do
+    local jobKey = 'executionJob:' .. executionId
+    local job = redis.call('HMGET', jobKey, 'userId', 'helperId', 'status', 'shard')
+    redis.call('ZREM', queue_key(job[4]), executionId)
+    if job[1] then
+        redis.call('SREM', 'userJobs:' .. job[1], executionId)
+        redis.call('SREM', 'helperJobs:' .. job[2], executionId)
+    end
+    if job[3] == 'queued' then
+        finalize_job(jobKey, job[2], 'cancelled', ARGV[1], ARGV[2], ARGV[3])
+        cancelled = cancelled + 1
+    end
+end
+return cancelled
+"""
+
+# running jobs are counted per user and per helper across all workers, so quotas hold cluster-wide.
+# a claim that left jobs queued because of a quota marks the user/helper, and freeing one of their slots wakes every dispatcher ('*')
+RELEASE_SLOT_FUNCTION = """
+local function release_slot(userId, helperId)
+    local wakeup = false
+    if userId then
+        if redis.call('HINCRBY', 'runningJobsByUser', userId, -1) <= 0 then
+            redis.call('HDEL', 'runningJobsByUser', userId)
+        end
+        wakeup = redis.call('SREM', 'quotaWaitingUsers', userId) == 1
+    end
+    if helperId then
+        if redis.call('HINCRBY', 'runningJobsByHelper', helperId, -1) <= 0 then
+            redis.call('HDEL', 'runningJobsByHelper', helperId)
+        end
+        wakeup = redis.call('SREM', 'quotaWaitingHelpers', helperId) == 1 or wakeup
+    end
+    if wakeup then
+        redis.call('PUBLISH', 'internalExecutionQueue:wakeup', '*')
+    end
+end
+"""
+
+# pops due jobs off a shard queue and marks them running in one step, so a job is only ever claimed once.
+# the claiming worker holds a lease on each job until it completes it or stops renewing it.
+# in fair mode the due window is shared weighted round-robin between users and helpers: per round each user, and each helper,
+# takes at most as many jobs as their priority.
+# jobs of users or helpers at their running quota, and of helpers the worker has no room for, are left queued.
+# returns how many were held back and the claimed jobs
+# KEYS: shard queue, running jobs, running per user, running per helper.
+# ARGV: max score, max jobs, worker id, lease expiry, scan window, fair (0/1), user quota, helper quota (0 = unlimited),
+# then pairs of helper id and how many more of its jobs the worker can take
+CLAIM_JOBS_SCRIPT = """
+local limit = tonumber(ARGV[2])
+local fair = ARGV[6] == '1'
+local userQuota = tonumber(ARGV[7])
+local helperQuota = tonumber(ARGV[8])
+local helperRoom = {}
+for i = 9, #ARGV, 2 do
+    helperRoom[ARGV[i]] = tonumber(ARGV[i + 1])
+end
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[5]))
+
+local groups = {}
+local order = {}
+for _, executionId in ipairs(ids) do
+    local job = redis.call('HMGET', 'executionJob:' .. executionId, 'userId', 'helperId', 'status', 'priority')
+    if job[3] ~= 'queued' then
+        -- leftovers of cancelled or finished jobs
+        redis.call('ZREM', KEYS[1], executionId)
+        if job[1] then
+            redis.call('SREM', 'userJobs:' .. job[1], executionId)
+            redis.call('SREM', 'helperJobs:' .. job[2], executionId)
+        end
+    else
+        local group = fair and job[1] or ''
+        if not groups[group] then
+            groups[group] = {}
+            table.insert(order, group)
+        end
+        table.insert(groups[group], {executionId, job[1], job[2], tonumber(job[4]) or 3})
+    end
+end
+
+local running = {}
+local function running_count(key, field)
+    local cacheKey = key .. ':' .. field
+    if running[cacheKey] == nil then
+        running[cacheKey] = tonumber(redis.call('HGET', key, field) or '0')
+    end
+    return running[cacheKey]
+end
+
+local claimed = {}
+local blocked = 0
+local progress = true
+while progress and #claimed < limit do
+    progress = false
+    -- in fair mode each helper also takes at most its priority per round, across all users,
+    -- so one helper spread over many users can't fill the window either
+    local helperTaken = {}
+    for _, group in ipairs(order) do
+        local remaining = {}
+        local taken = 0
+        for _, entry in ipairs(groups[group]) do
+            local executionId, userId, helperId, priority = unpack(entry)
+            local waiting = #claimed >= limit or (fair and (taken >= priority or (helperTaken[helperId] or 0) >= priority))
+            local userFull = not waiting and userQuota > 0 and userId ~= 'internal' and running_count(KEYS[3], userId) >= userQuota
+            local helperFull = not waiting and ((helperRoom[helperId] and helperRoom[helperId] <= 0) or (helperQuota > 0 and running_count(KEYS[4], helperId) >= helperQuota))
+            if waiting then
+                table.insert(remaining, entry)
+            elseif userFull or helperFull then
+                blocked = blocked + 1
+                if userFull then
+                    redis.call('SADD', 'quotaWaitingUsers', userId)
+                end
+                if helperFull then
+                    redis.call('SADD', 'quotaWaitingHelpers', helperId)
+                end
+            else
+                local jobKey = 'executionJob:' .. executionId
+                redis.call('ZREM', KEYS[1], executionId)
+                redis.call('SREM', 'userJobs:' .. userId, executionId)
+                redis.call('SREM', 'helperJobs:' .. helperId, executionId)
+                redis.call('HSET', jobKey, 'status', 'running', 'leaseOwner', ARGV[3], 'leaseExpiresAt', ARGV[4])
+                redis.call('ZADD', KEYS[2], ARGV[4], executionId)
+                running[KEYS[3] .. ':' .. userId] = redis.call('HINCRBY', KEYS[3], userId, 1)
+                running[KEYS[4] .. ':' .. helperId] = redis.call('HINCRBY', KEYS[4], helperId, 1)
+                table.insert(claimed, redis.call('HGETALL', jobKey))
+                taken = taken + 1
+                helperTaken[helperId] = (helperTaken[helperId] or 0) + 1
+                if helperRoom[helperId] then
+                    helperRoom[helperId] = helperRoom[helperId] - 1
+                end
+                progress = true
+            end
+        end
+        groups[group] = remaining
+    end
+end
+return {blocked, claimed}
+"""
+
+# KEYS: running jobs. ARGV: worker id, lease expiry, execution ids...
+RENEW_LEASES_SCRIPT = """
+local lost = {}
+for i = 3, #ARGV do
+    local jobKey = 'executionJob:' .. ARGV[i]
+    if redis.call('HGET', jobKey, 'leaseOwner') == ARGV[1] then
+        redis.call('HSET', jobKey, 'leaseExpiresAt', ARGV[2])
+        redis.call('ZADD', KEYS[1], ARGV[2], ARGV[i])
+    else
+        table.insert(lost, ARGV[i])
+    end
+end
+return lost
+"""
+
+# only the lease owner can finish a job, a job that was re-queued after its lease expired is left alone
+# KEYS: running jobs. ARGV: execution id, worker id, status, retention, summary key, summary retention
+COMPLETE_JOB_SCRIPT = FINALIZE_JOB_FUNCTION + RELEASE_SLOT_FUNCTION + """
+local jobKey = 'executionJob:' .. ARGV[1]
+if redis.call('HGET', jobKey, 'leaseOwner') ~= ARGV[2] then
+    return 0
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', jobKey, 'leaseOwner', 'leaseExpiresAt')
+local job = redis.call('HMGET', jobKey, 'userId', 'helperId')
+release_slot(job[1], job[2])
+finalize_job(jobKey, job[2], ARGV[3], ARGV[4], ARGV[5], ARGV[6])
+return 1
+"""
+
+# puts a running job back in its shard queue. returns the shard, or nil if the job wasn't running
+REQUEUE_JOB_FUNCTION = QUEUE_KEY_FUNCTION + RELEASE_SLOT_FUNCTION + """
+local function requeue_job(executionId)
+    local jobKey = 'executionJob:' .. executionId
+    local job = redis.call('HMGET', jobKey, 'userId', 'helperId', 'status', 'executionScore', 'shard')
+    if job[3] ~= 'running' then
+        return nil
+    end
+    release_slot(job[1], job[2])
+    redis.call('HDEL', jobKey, 'leaseOwner', 'leaseExpiresAt')
+    redis.call('HSET', jobKey, 'status', 'queued')
+    redis.call('ZADD', queue_key(job[5]), job[4], executionId)
+    redis.call('SADD', 'userJobs:' .. job[1], executionId)
+    redis.call('SADD', 'helperJobs:' .. job[2], executionId)
+    return job[5] or 'global'
+end
+"""
+
+# puts jobs whose worker stopped renewing their lease back in their shard queue
+# KEYS: running jobs. ARGV: now, max jobs, wakeup channel
+REQUEUE_EXPIRED_LEASES_SCRIPT = REQUEUE_JOB_FUNCTION + """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+local requeued = 0
+local shards = {}
+for _, executionId in ipairs(ids) do
+    redis.call('ZREM', KEYS[1], executionId)
+    local shard = requeue_job(executionId)
+    if shard then
+        shards[shard] = true
+        requeued = requeued + 1
+    end
+end
+for shard, _ in pairs(shards) do
+    redis.call('PUBLISH', ARGV[3], shard)
+end
+return requeued
+"""
+
+# hands jobs a worker still holds back to the queue right away, e.g. when it shuts down
+# KEYS: running jobs. ARGV: worker id, wakeup channel, execution ids...
+RELEASE_JOBS_SCRIPT = REQUEUE_JOB_FUNCTION + """
+local released = 0
+local shards = {}
+for i = 3, #ARGV do
+    if redis.call('HGET', 'executionJob:' .. ARGV[i], 'leaseOwner') == ARGV[1] then
+        redis.call('ZREM', KEYS[1], ARGV[i])
+        local shard = requeue_job(ARGV[i])
+        if shard then
+            shards[shard] = true
+            released = released + 1
+        end
+    end
+end
+for shard, _ in pairs(shards) do
+    redis.call('PUBLISH', ARGV[2], shard)
+end
+return released
+"""
+
+# a failed job either goes back to its shard queue to be retried at ARGV[3], or to the dead-letter set when ARGV[3] is 0.
+# only the lease owner can fail a job, like completing it
+# KEYS: running jobs, dead-letter jobs.
+# ARGV: execution id, worker id, retry at, retry score, error, now, wakeup channel, retention, summary key, summary retention
+FAIL_JOB_SCRIPT = QUEUE_KEY_FUNCTION + FINALIZE_JOB_FUNCTION + RELEASE_SLOT_FUNCTION + """
+local jobKey = 'executionJob:' .. ARGV[1]
+if redis.call('HGET', jobKey, 'leaseOwner') ~= ARGV[2] then
+    return 0
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', jobKey, 'leaseOwner', 'leaseExpiresAt')
+local job = redis.call('HMGET', jobKey, 'userId', 'helperId', 'shard')
+release_slot(job[1], job[2])
+redis.call('HINCRBY', jobKey, 'attempts', 1)
+redis.call('HSET', jobKey, 'lastError', ARGV[5])
+
+if tonumber(ARGV[3]) > 0 then
+    local queue = queue_key(job[3])
+    redis.call('HSET', jobKey, 'status', 'queued', 'executionScore', ARGV[4], 'retryAt', ARGV[3])
+    redis.call('ZADD', queue, ARGV[4], ARGV[1])
+    redis.call('SADD', 'userJobs:' .. job[1], ARGV[1])
+    redis.call('SADD', 'helperJobs:' .. job[2], ARGV[1])
+    if redis.call('ZRANGE', queue, 0, 0)[1] == ARGV[1] then
+        redis.call('PUBLISH', ARGV[7], job[3] or 'global')
+    end
+    return 1
+end
+
+redis.call('ZADD', KEYS[2], ARGV[6], ARGV[1])
+finalize_job(jobKey, job[2], 'dead_lettered', ARGV[8], ARGV[9], ARGV[10])
+return 2
+"""
+
+# a deferred job goes back to its shard queue to run again at ARGV[3], without using up an attempt.
+# only the lease owner can defer a job, like completing it
+# KEYS: running jobs. ARGV: execution id, worker id, run at, score, wakeup channel
+DEFER_JOB_SCRIPT = QUEUE_KEY_FUNCTION + RELEASE_SLOT_FUNCTION + """
+local jobKey = 'executionJob:' .. ARGV[1]
+if redis.call('HGET', jobKey, 'leaseOwner') ~= ARGV[2] then
+    return 0
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', jobKey, 'leaseOwner', 'leaseExpiresAt')
+local job = redis.call('HMGET', jobKey, 'userId', 'helperId', 'shard')
+release_slot(job[1], job[2])
+local queue = queue_key(job[3])
+redis.call('HSET', jobKey, 'status', 'queued', 'executionScore', ARGV[4], 'retryAt', ARGV[3])
+redis.call('ZADD', queue, ARGV[4], ARGV[1])
+redis.call('SADD', 'userJobs:' .. job[1], ARGV[1])
+redis.call('SADD', 'helperJobs:' .. job[2], ARGV[1])
+if redis.call('ZRANGE', queue, 0, 0)[1] == ARGV[1] then
+    redis.call('PUBLISH', ARGV[5], job[3] or 'global')
+end
+return 1
+"""
+
+# moves a queued job to another shard, used when the shard layout changes
+# KEYS: current shard queue, new shard queue, job hash, shards set. ARGV: execution id, new shard
+MOVE_JOB_SCRIPT = """
+local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not score then
+    return 0
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZADD', KEYS[2], score, ARGV[1])
+redis.call('HSET', KEYS[3], 'shard', ARGV[2])
+redis.call('SADD', KEYS[4], ARGV[2])
+return 1
+"""
+
+# schedule index writes are fenced: they only apply while the leader lease still holds our token
+# KEYS: schedule index, leader key, change feed position.
+# ARGV: fencing token ("" = unfenced), last change id ("" = unchanged), removed count, removed entries..., member/score pairs...
+WRITE_SCHEDULE_SCRIPT = """
+if ARGV[1] ~= '' and redis.call('GET', KEYS[2]) ~= ARGV[1] then
+    return -1
+end
+local removed = tonumber(ARGV[3])
+for i = 4, 3 + removed do
+    redis.call('ZREM', KEYS[1], ARGV[i])
+end
+for i = 4 + removed, #ARGV, 2 do
+    redis.call('ZADD', KEYS[1], ARGV[i + 1], ARGV[i])
+end
+if ARGV[2] ~= '' then
+    redis.call('SET', KEYS[3], ARGV[2])
+end
+return 1
+"""
+
+enqueueJobScript = redisClient.register_script(ENQUEUE_JOB_SCRIPT)
+cancelJobsScript = redisClient.register_script(CANCEL_JOBS_SCRIPT)
+claimJobsScript = redisClient.register_script(CLAIM_JOBS_SCRIPT)
+renewLeasesScript = redisClient.register_script(RENEW_LEASES_SCRIPT)
+completeJobScript = redisClient.register_script(COMPLETE_JOB_SCRIPT)
+requeueExpiredLeasesScript = redisClient.register_script(REQUEUE_EXPIRED_LEASES_SCRIPT)
+releaseJobsScript = redisClient.register_script(RELEASE_JOBS_SCRIPT)
+failJobScript = redisClient.register_script(FAIL_JOB_SCRIPT)
+deferJobScript = redisClient.register_script(DEFER_JOB_SCRIPT)
+moveJobScript = redisClient.register_script(MOVE_JOB_SCRIPT)
+writeScheduleScript = redisClient.register_script(WRITE_SCHEDULE_SCRIPT)
+
 
 class QueueTools:
     def __init__(self, logger):
         self.logger = logger
+        self.batchSize = int(os.environ.get("QUEUE_BATCH_SIZE", 500))
+        self.jobRetention = int(os.environ.get("JOB_RETENTION_SECONDS", 6 * 3600))
+        self.summaryRetention = int(os.environ.get("JOB_SUMMARY_RETENTION_SECONDS", 7 * 24 * 3600))
+        self.compactorInterval = int(os.environ.get("JOB_COMPACTOR_INTERVAL", 600))
+        self.scheduleHorizon = int(os.environ.get("SCHEDULE_HORIZON_SECONDS", 2 * 3600))
+        self.scheduleRefill = int(os.environ.get("SCHEDULE_REFILL_SECONDS", 30 * 60))
+        self.scheduleTick = int(os.environ.get("SCHEDULE_TICK_SECONDS", 60))
+        self.buildParallelism = int(os.environ.get("QUEUE_BUILD_PARALLELISM", 8))
+        self.buildChunkSize = int(os.environ.get("QUEUE_BUILD_CHUNK_SIZE", 100))
+        self.lastChangeId = None
+        self.changeFailures = {}  # change feed entry id -> failed attempts, for the entry the feed is stuck on
+        # set while this instance is the queue updater leader, see utils/leader.py
+        self.fencingToken = None
+        self.fairClaims = os.environ.get("QUEUE_FAIR_CLAIMS", "false").lower() == "true"
+        self.fairScanFactor = int(os.environ.get("QUEUE_FAIR_SCAN_FACTOR", 10))
+        self.userQuota = int(os.environ.get("USER_MAX_RUNNING_JOBS", 0))
+        self.helperQuota = int(os.environ.get("HELPER_MAX_RUNNING_JOBS", 0))
+        # set when the last claim left due jobs queued because of a quota
+        self.quotaBlocked = False
+        self.maxAttempts = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+        self.retryBaseDelay = int(os.environ.get("JOB_RETRY_BASE_SECONDS", 30))
+        self.retryMaxDelay = int(os.environ.get("JOB_RETRY_MAX_SECONDS", 3600))
+        # retries may run this long after the job was due, even if that's past its executionExpiry
+        self.retryWindow = int(os.environ.get("JOB_RETRY_WINDOW_SECONDS", 3600))
+        self.deadLetterRetention = int(os.environ.get("JOB_DEAD_LETTER_RETENTION_SECONDS", 7 * 24 * 3600))
+        # e.g. "PT=iberia,ES=iberia". regions without an entry get their own shard
+        self.shardMap = dict(entry.split("=", 1) for entry in os.environ.get("QUEUE_SHARD_MAP", "").split(",") if "=" in entry)
+
+    def queue_shard(self, region: str = None):
+        # internal and region-less jobs go to the global shard
+        if not region or region == "*":
+            return "global"
+        return self.shardMap.get(region, region)
+
+    def job_region(self, helperConfig: dict, user: dict = None):
+        # helpers locked to a single region run in that region's shard, the rest follow the user
+        regionLock = helperConfig.get("region_lock") or []
+        if len(regionLock) == 1 and regionLock[0] != "*":
+            return regionLock[0]
+        return user.get("region") if user else None
+
+    def queue_key(self, shard: str):
+        return f"{QUEUE_PREFIX}:{shard}"
 
-    async def queue_job(self, helper_id: str, user_id: str, execution_time: int, priority: int, execution_expiry: int):
-        jobData = {
-            "executionId": str(uuid.uuid4()),
+    async def get_shards(self):
+        return sorted(await redisClient.smembers("executionQueueShards"))
+
+    def job_id(self, helper_id: str, user_id: str, execution_time: int):
+        return f"{helper_id}:{user_id}:{int(execution_time)}"
+
+    def execution_expiry(self, helperConfig: dict):
+        # how long a queued run may start late, the helper's timeout unless it sets its own
+        return helperConfig.get("execution_expiry") or helperConfig.get("timeout", 3600)
+
+    def build_job(self, helper_id: str, user_id: str, execution_time: int, priority: int, execution_expiry: int, region: str = None):
+        return {
+            "executionId": self.job_id(helper_id, user_id, execution_time),
             "userId": user_id,
             "helperId": helper_id,
+            "region": region or "*",
+            "shard": self.queue_shard(region),
             "executionTime": execution_time, # scheduled time
             "executionScore": execution_time * 10 + (6 - priority),
             "priority": priority,
@@ -27,287 +471,727 @@ class QueueTools:
             "status": "queued"
         }
 
-        await redisClient.hset(f"executionJob:{jobData['executionId']}", mapping=jobData)
+    async def queue_jobs(self, jobs: list, batch_size: int = None):
+        # flushes jobs in MULTI/EXEC pipelines, one round-trip per batch. idempotent, returns how many were new
+        if not jobs:
+            return 0
+
+        batchSize = batch_size or self.batchSize
+        startedAt = time.perf_counter()
+        insertedJobs = 0
+
+        for i in range(0, len(jobs), batchSize):
+            async with redisClient.pipeline(transaction=True) as pipe:
+                for jobData in jobs[i:i + batchSize]:
+                    fields = [value for item in jobData.items() for value in item]
+                    await enqueueJobScript(
+                        keys=[
+                            f"executionJob:{jobData['executionId']}",
+                            self.queue_key(jobData["shard"]),
+                            f"userJobs:{jobData['userId']}",
+                            f"helperJobs:{jobData['helperId']}",
+                            "executionQueueShards",
+                            "executionJobs",
+                        ],
+                        args=[jobData["executionId"], jobData["executionScore"], WAKEUP_CHANNEL, jobData["shard"], *fields],
+                        client=pipe,
+                    )
+                results = await pipe.execute()
+            insertedJobs += sum(int(result) for result in results)
+
+        elapsed = time.perf_counter() - startedAt
+        self.logger.debug(f"[QUEUE] Flushed {len(jobs)} jobs ({insertedJobs} new) in {elapsed:.3f}s ({len(jobs) / max(elapsed, 1e-6):.0f} jobs/s).")
+        return insertedJobs
+
+    def summary_key(self, time: int = None):
+        bucket = datetime.datetime.fromtimestamp(time or datetime.datetime.now().timestamp(), datetime.timezone.utc)
+        return f"executionSummary:{bucket.strftime('%Y%m%d%H')}"
 
-        await redisClient.zadd("internalExecutionQueue", {jobData['executionId']: jobData['executionScore']})
+    def retention_args(self):
+        return [self.jobRetention, self.summary_key(), self.summaryRetention]
 
-    async def dequeue_job(self, execution_id: str):
-        await redisClient.zrem("internalExecutionQueue", execution_id)
-        await redisClient.hset(f"executionJob:{execution_id}", mapping={"status": "cancelled"})
+    async def cancel_user_jobs(self, user_id: str):
+        return await cancelJobsScript(keys=[f"userJobs:{user_id}"], args=self.retention_args())
+
+    async def cancel_helper_jobs(self, helper_id: str):
+        return await cancelJobsScript(keys=[f"helperJobs:{helper_id}"], args=self.retention_args())
     
+    async def claim_due_jobs(self, time: int, limit: int, worker_id: str, lease_expires_at: int, shards: list, helper_room: dict = None):
+        # helper_room caps how many more jobs of a helper the worker takes, helpers without room are held back like a quota.
+        # shards are visited in random order so a busy shard can't starve the others
+        helperRoom = dict(helper_room or {})
+        shards = random.sample(shards, len(shards))
+        claimedJobs = []
+        self.quotaBlocked = False
+        for shard in shards:
+            if len(claimedJobs) >= limit:
+                break
+            remaining = limit - len(claimedJobs)
+            # fair claims and quotas look past the first due jobs, so a noisy user can't fill the whole window
+            scanWindow = remaining * self.fairScanFactor if self.fairClaims or self.userQuota or self.helperQuota else remaining
+            # + 9 so every priority scheduled for the current second is due
+            blocked, jobs = await claimJobsScript(
+                keys=[self.queue_key(shard), "runningJobs", "runningJobsByUser", "runningJobsByHelper"],
+                args=[
+                    time * 10 + 9, remaining, worker_id, lease_expires_at,
+                    scanWindow, int(self.fairClaims), self.userQuota, self.helperQuota,
+                    *itertools.chain.from_iterable(helperRoom.items()),
+                ],
+            )
+            claimedJobs += jobs
+            for job in jobs:
+                helperId = job[job.index("helperId") + 1]
+                if helperId in helperRoom:
+                    helperRoom[helperId] -= 1
+            self.quotaBlocked = self.quotaBlocked or blocked > 0
+        return [dict(zip(job[::2], job[1::2])) for job in claimedJobs]
+
+    async def renew_leases(self, worker_id: str, execution_ids: list, lease_expires_at: int):
+        # returns the jobs this worker no longer owns
+        if not execution_ids:
+            return []
+        return await renewLeasesScript(keys=["runningJobs"], args=[worker_id, lease_expires_at, *execution_ids])
+
+    async def complete_job(self, execution_id: str, worker_id: str, status: str):
+        return await completeJobScript(keys=["runningJobs"], args=[execution_id, worker_id, status, *self.retention_args()])
+
+    def retry_delay(self, attempts: int):
+        # exponential backoff with jitter, so jobs failing together don't all come back in the same second
+        delay = min(self.retryMaxDelay, self.retryBaseDelay * 2 ** (attempts - 1))
+        return random.uniform(delay / 2, delay)
+
+    async def fail_job(self, job: dict, worker_id: str, error: str):
+        # retries the job with backoff until it runs out of attempts (or would retry past its retry window), then dead-letters it.
+        # returns 1 when retried, 2 when dead-lettered and 0 when the lease was lost
+        currentTime = int(datetime.datetime.now().timestamp())
+        helperConfig = await systemTools.get_registered_helper(job["helperId"]) or {}
+        maxAttempts = helperConfig.get("max_attempts") or self.maxAttempts
+        attempts = int(job.get("attempts", 0)) + 1
+
+        retryAt = 0
+        if attempts < maxAttempts:
+            retryAt = currentTime + int(self.retry_delay(attempts))
+            if retryAt > int(job["executionTime"]) + max(int(job["executionExpiry"]), self.retryWindow):
+                retryAt = 0
+
+        result = await failJobScript(
+            keys=["runningJobs", "deadLetterJobs"],
+            args=[
+                job["executionId"], worker_id, retryAt, retryAt * 10 + (6 - int(job.get("priority", 3))), str(error)[:500],
+                currentTime, WAKEUP_CHANNEL, self.deadLetterRetention, self.summary_key(), self.summaryRetention,
+            ],
+        )
+        if result == 1:
+            self.logger.warn(f"[QUEUE] Job {job['executionId']} failed (attempt {attempts}/{maxAttempts}). Retrying in {retryAt - currentTime}s.")
+        elif result == 2:
+            self.logger.error(f"[QUEUE] Job {job['executionId']} failed after {attempts} attempts. Moved to the dead-letter queue.")
+        return result
+
+    async def defer_job(self, job: dict, worker_id: str, run_at: int):
+        # queues the job again for run_at. a job can't be deferred past its retry window, it expires instead.
+        # returns 1 when deferred, 2 when expired and 0 when the lease was lost
+        if run_at > int(job["executionTime"]) + max(int(job["executionExpiry"]), self.retryWindow):
+            self.logger.warn(f"[QUEUE] Job {job['executionId']} can't be deferred past its retry window. Expiring it.")
+            return 2 if await self.complete_job(job["executionId"], worker_id, "expired") else 0
+        return await deferJobScript(
+            keys=["runningJobs"],
+            args=[job["executionId"], worker_id, run_at, run_at * 10 + (6 - int(job.get("priority", 3))), WAKEUP_CHANNEL],
+        )
+
+    async def get_dead_letters(self, limit: int = 100):
+        executionIds = await redisClient.zrevrange("deadLetterJobs", 0, limit - 1)
+        async with redisClient.pipeline(transaction=False) as pipe:
+            for executionId in executionIds:
+                pipe.hgetall(f"executionJob:{executionId}")
+            return [job for job in await pipe.execute() if job]
+
+    async def get_execution_summary(self, hours: int = 24):
+        currentTime = int(datetime.datetime.now().timestamp())
+        async with redisClient.pipeline(transaction=False) as pipe:
+            for hour in range(hours):
+                pipe.hgetall(self.summary_key(currentTime - hour * 3600))
+            buckets = await pipe.execute()
+
+        summary = {}
+        for bucket in buckets:
+            for field, count in bucket.items():
+                summary[field] = summary.get(field, 0) + int(count)
+        return summary
+
+    async def compact_jobs(self):
+        # gives a ttl to finished jobs that don't have one yet (e.g. written before retention existed or by an interrupted worker)
+        # and drops jobs that already expired from the executionJobs index. SSCAN walks the index in small steps so redis is never blocked
+        expiredJobs = 0
+        executionIds = []
+        async for executionId in redisClient.sscan_iter("executionJobs", count=self.batchSize):
+            executionIds.append(executionId)
+            if len(executionIds) >= self.batchSize:
+                expiredJobs += await self._expire_finished_jobs(executionIds)
+                executionIds = []
+        expiredJobs += await self._expire_finished_jobs(executionIds)
+        return expiredJobs
+
+    async def _expire_finished_jobs(self, executionIds: list):
+        if not executionIds:
+            return 0
+        async with redisClient.pipeline(transaction=False) as pipe:
+            for executionId in executionIds:
+                pipe.hget(f"executionJob:{executionId}", "status")
+                pipe.ttl(f"executionJob:{executionId}")
+            results = await pipe.execute()
+
+        goneIds = []
+        finishedIds = []
+        for executionId, status, ttl in zip(executionIds, results[::2], results[1::2]):
+            if status is None:
+                goneIds.append(executionId)
+            elif status in TERMINAL_STATUSES and ttl == -1:
+                finishedIds.append(executionId)
+
+        async with redisClient.pipeline(transaction=False) as pipe:
+            if goneIds:
+                pipe.srem("executionJobs", *goneIds)
+            for executionId in finishedIds:
+                pipe.expire(f"executionJob:{executionId}", self.jobRetention)
+            await pipe.execute()
+        return len(finishedIds)
+
+    async def run_compactor(self):
+        while True:
+            try:
+                startedAt = time.perf_counter()
+                expiredJobs = await self.compact_jobs()
+                # the dead-letter jobs themselves expire on their own
+                await redisClient.zremrangebyscore("deadLetterJobs", "-inf", int(datetime.datetime.now().timestamp()) - self.deadLetterRetention)
+                self.logger.info(f"[COMPACTOR] Set retention on {expiredJobs} finished jobs in {time.perf_counter() - startedAt:.2f}s.")
+            except Exception as e:
+                self.logger.error("[COMPACTOR] Error compacting execution jobs.", e)
+            await asyncio.sleep(self.compactorInterval)
+
+    async def requeue_orphaned_jobs(self, worker_id: str):
+        # running jobs whose owner has no live heartbeat (or is a previous run of this worker) go straight back to the queue
+        runningJobs = await redisClient.zrange("runningJobs", 0, -1)
+        if not runningJobs:
+            return 0
+
+        async with redisClient.pipeline(transaction=False) as pipe:
+            for executionId in runningJobs:
+                pipe.hget(f"executionJob:{executionId}", "leaseOwner")
+            owners = await pipe.execute()
+
+        aliveOwners = set()
+        for owner in set(owners):
+            if owner and owner != worker_id and await redisClient.exists(f"dispatcherWorker:{owner}"):
+                aliveOwners.add(owner)
+
+        orphanedJobs = [executionId for executionId, owner in zip(runningJobs, owners) if owner not in aliveOwners]
+        if not orphanedJobs:
+            return 0
+        await redisClient.zadd("runningJobs", {executionId: 0 for executionId in orphanedJobs}, xx=True)
+        return await self.requeue_expired_leases(int(datetime.datetime.now().timestamp()), limit=len(orphanedJobs))
+
+    async def reconcile_queue(self, loaded_helpers: list, worker_id: str):
+        # warm restart: drop helpers that no longer exist and recover jobs left running by the previous process
+        for helper in await systemTools.get_all_helpers():
+            if helper["id"] not in loaded_helpers:
+                await systemTools.unregister_helper(helper["id"])
+                cancelledJobs = await self.cancel_helper_jobs(helper["id"])
+                self.logger.warn(f"[QUEUE] Helper {helper['id']} no longer exists. Cancelled {cancelledJobs} queued jobs.")
+
+        requeuedJobs = await self.requeue_orphaned_jobs(worker_id)
+        queuedJobs = 0
+        for shard in await self.get_shards():
+            queuedJobs += await redisClient.zcard(self.queue_key(shard))
+        self.logger.info(f"[QUEUE] Reconciled execution queue: {queuedJobs} queued jobs kept, {requeuedJobs} orphaned jobs re-queued.")
+
+    async def requeue_expired_leases(self, time: int, limit: int = 1000):
+        return await requeueExpiredLeasesScript(keys=["runningJobs"], args=[time, limit, WAKEUP_CHANNEL])
+
+    async def release_worker_jobs(self, worker_id: str):
+        # every job still leased by this worker goes back to the queue, including claims that never reached the executor
+        runningJobs = await redisClient.zrange("runningJobs", 0, -1)
+        if not runningJobs:
+            return 0
+        return await releaseJobsScript(keys=["runningJobs"], args=[worker_id, WAKEUP_CHANNEL, *runningJobs])
+
+    async def get_next_execution_time(self, shards: list):
+        async with redisClient.pipeline(transaction=False) as pipe:
+            for shard in shards:
+                pipe.zrange(self.queue_key(shard), 0, 0, withscores=True)
+            heads = await pipe.execute()
+
+        scores = [head[0][1] for head in heads if head]
+        if not scores:
+            return None
+        return int(min(scores)) // 10
+
+    async def listen_for_wakeups(self, wakeup_event: asyncio.Event, shards: list = None):
+        # wakeups carry the shard name, dispatchers only care about the shards they serve (None means all)
+        while True:
+            try:
+                # closed on the way out, so a reconnect doesn't leave the old connection behind
+                async with redisClient.pubsub() as pubsub:
+                    await pubsub.subscribe(WAKEUP_CHANNEL)
+                    async for message in pubsub.listen():
+                        if message["type"] == "message" and (shards is None or message["data"] in shards or message["data"] == "*"):
+                            wakeup_event.set()
+            except Exception as e:
+                self.logger.error("[DISPATCHER] Lost queue wakeup subscription. Reconnecting...", e)
+                wakeup_event.set()
+                await asyncio.sleep(1)
+
+    async def wait_for_next_job(self, wakeup_event: asyncio.Event, max_idle: float, shards: list, quota_blocked: bool = False):
+        # cleared before reading the heads, so a job queued meanwhile still wakes us up
+        wakeup_event.clear()
+        if quota_blocked:
+            # the head is due but held back by a quota, so we wait for a slot to be released instead (rechecking now and then)
+            timeout = min(max_idle, QUOTA_RECHECK_SECONDS)
+        else:
+            nextExecution = await self.get_next_execution_time(shards)
+            timeout = max_idle if nextExecution is None else min(max_idle, nextExecution - time.time())
+
+        if timeout <= 0:
+            return
+        try:
+            await asyncio.wait_for(wakeup_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        
+    async def clear_queue(self):
+        # every job is in the executionJobs index and the userJobs/helperJobs sets only hold queued jobs,
+        # so everything is found through the index without walking the keyspace. UNLINK frees memory off the main thread.
+        # queued, running and dead-lettered jobs are also looked up directly, for jobs written before the index existed
+        shardQueues = [self.queue_key(shard) for shard in await self.get_shards()]
+        executionIds = {executionId async for executionId in redisClient.sscan_iter("executionJobs", count=self.batchSize)}
+        for key in [QUEUE_PREFIX, *shardQueues, "runningJobs", "deadLetterJobs"]:
+            executionIds.update([executionId async for executionId, _ in redisClient.zscan_iter(key, count=self.batchSize)])
+        executionIds = list(executionIds)
+        for i in range(0, len(executionIds), self.batchSize):
+            batch = executionIds[i:i + self.batchSize]
+            async with redisClient.pipeline(transaction=False) as pipe:
+                for executionId in batch:
+                    pipe.hmget(f"executionJob:{executionId}", "userId", "helperId")
+                owners = await pipe.execute()
+
+            keys = {f"executionJob:{executionId}" for executionId in batch}
+            for userId, helperId in owners:
+                if userId:
+                    keys.update((f"userJobs:{userId}", f"helperJobs:{helperId}"))
+            await redisClient.unlink(*keys)
+
+        await redisClient.unlink(
+            QUEUE_PREFIX, *shardQueues,
+            "executionQueueShards", "executionJobs", "runningJobs", "runningJobsByUser", "runningJobsByHelper", "quotaWaitingUsers", "quotaWaitingHelpers",
+            "scheduleNextRuns", "schedulingChanges:lastId", "deadLetterJobs",
+        )
+
+    async def rebalance_shards(self):
+        # moves queued jobs whose shard changed (e.g. QUEUE_SHARD_MAP was edited) to their new shard
+        shardMap = ",".join(f"{region}={shard}" for region, shard in sorted(self.shardMap.items()))
+        if await redisClient.get("executionQueueShardMap") == shardMap:
+            return 0
+
+        movedJobs = 0
+        for shard in await self.get_shards():
+            executionIds = [executionId async for executionId, _ in redisClient.zscan_iter(self.queue_key(shard), count=self.batchSize)]
+            for i in range(0, len(executionIds), self.batchSize):
+                batch = executionIds[i:i + self.batchSize]
+                async with redisClient.pipeline(transaction=False) as pipe:
+                    for executionId in batch:
+                        pipe.hget(f"executionJob:{executionId}", "region")
+                    regions = await pipe.execute()
+
+                async with redisClient.pipeline(transaction=False) as pipe:
+                    for executionId, region in zip(batch, regions):
+                        newShard = self.queue_shard(None if region == "*" else region)
+                        if newShard != shard:
+                            await moveJobScript(
+                                keys=[self.queue_key(shard), self.queue_key(newShard), f"executionJob:{executionId}", "executionQueueShards"],
+                                args=[executionId, newShard],
+                                client=pipe,
+                            )
+                    movedJobs += sum(int(result) for result in await pipe.execute())
+
+        await redisClient.set("executionQueueShardMap", shardMap)
+        self.logger.info(f"[QUEUE] Rebalanced execution queue shards. Moved {movedJobs} jobs.")
+        return movedJobs
+
+    # Scheduling
+    # every scheduled (user, helper) pair has its next not-yet-queued run time in the scheduleNextRuns ZSET,
+    # so finding what needs queueing is a range query. internal helpers use "internal" as the user id
+
+    async def run_chunks(self, items: list, worker):
+        # splits items into chunks and runs up to buildParallelism of them at once, each chunk pipelines its own writes
+        semaphore = asyncio.Semaphore(self.buildParallelism)
+
+        async def run(chunk):
+            async with semaphore:
+                return await worker(chunk)
+
+        return await asyncio.gather(*(run(items[i:i + self.buildChunkSize]) for i in range(0, len(items), self.buildChunkSize)))
+
+    def schedule_member(self, user_id: str, helper_id: str):
+        return f"{user_id}:{helper_id}"
+
+    def service_schedule(self, user: dict, service: dict, helperConfig: dict, tag: str = "[QUEUE]"):
+        # cron expressions to schedule for one of the user's services, None if it can't be scheduled
+        if not service.get("enabled"):
+            return None
+        if not helperConfig or helperConfig["disabled"] or helperConfig["internal"]:
+            self.logger.warn(f"{tag} Helper {service['id']} is not available. Skipping scheduling for user {user['id']}.")
+            return None
+        if user["region"] not in helperConfig["region_lock"] and helperConfig["region_lock"] != ["*"]:
+            self.logger.warn(f"{tag} Helper {service['id']} is not available in user {user['id']} region ({user['region']}). Skipping scheduling.")
+            return None
+        if helperConfig["admin_only"] and not user["admin"]:
+            self.logger.warn(f"{tag} Helper {service['id']} is admin-only. Skipping scheduling for non-admin user {user['id']}.")
+            return None
+
+        if helperConfig["allow_execution_time_config"]:
+            return service["schedule"]
+        return helperConfig["schedule"]
+
+    def build_scheduled_jobs(self, helper_id: str, user_id: str, expressions: list, helperConfig: dict, start: int, end: int, region: str = None):
+        jobs = []
+        for expression in expressions:
+            try:
+                for ts in systemTools.cron_to_timestamps(expression, start, end):
+                    jobs.append(self.build_job(
+                        helper_id=helper_id,
+                        user_id=user_id,
+                        execution_time=ts,
+                        priority=helperConfig.get("priority", 3),
+                        execution_expiry=self.execution_expiry(helperConfig),
+                        region=region,
+                    ))
+            except Exception as e:
+                self.logger.error(f"[QUEUE] Invalid cron expression '{expression}' for helper {helper_id}. Skipping.", e)
+        return jobs
+
+    def next_run_time(self, helper_id: str, expressions: list, after: int):
+        nextRuns = []
+        for expression in expressions:
+            try:
+                nextRuns.append(systemTools.next_fire_time(expression, after))
+            except Exception as e:
+                self.logger.error(f"[QUEUE] Invalid cron expression '{expression}' for helper {helper_id}. Skipping.", e)
+        return min(nextRuns) if nextRuns else None
+
+    async def write_schedule(self, nextRuns: dict = {}, removedEntries: list = [], lastChangeId: str = None):
+        result = await writeScheduleScript(
+            keys=["scheduleNextRuns", LEADER_KEY, "schedulingChanges:lastId"],
+            args=[
+                self.fencingToken or "", lastChangeId or "", len(removedEntries), *removedEntries,
+                *[value for member, nextRun in nextRuns.items() for value in (member, nextRun)],
+            ],
+        )
+        if result == -1:
+            raise LeadershipLost(f"Fencing token {self.fencingToken} is no longer current")
+
+    async def flush_schedule(self, jobs: list, nextRuns: dict, removedEntries: list = []):
+        # queueing is insert-if-absent, so only the schedule index needs fencing. the early check keeps a stale leader from queueing at all
+        if self.fencingToken and await redisClient.get(LEADER_KEY) != self.fencingToken:
+            raise LeadershipLost(f"Fencing token {self.fencingToken} is no longer current")
+        queuedJobs = await self.queue_jobs(jobs)
+        if nextRuns or removedEntries:
+            await self.write_schedule(nextRuns, removedEntries)
+        return queuedJobs
+
     async def update_queue_for_user(self, user_id):
         userData = await authTools.get_user_by_id(user_id)
-        userJobs = await redisClient.zrange("internalExecutionQueue", 0, -1)
-        for job in userJobs:
-            job = str(job).replace("executionJob:", "")
-            jobDetails = await self.get_job_details(job)
-            if jobDetails.get("userId") == user_id:
-                await self.dequeue_job(jobDetails["executionId"])
-        
-        userHelpers = userData["services"]
+        await self.cancel_user_jobs(user_id)
+        if not userData or userData.get("status") != "active":
+            self.logger.info(f"[QUEUE] User {user_id} is not active. Cancelled their jobs.")
+            return
+
         currentTime = int(datetime.datetime.now().timestamp())
-        lookahedTime = currentTime + 2 * 3600  # 2h
+        nextRuns = {}
 
-        for helper in userHelpers:
-            if helper["enabled"] == False:
+        for service in userData["services"]:
+            helperConfig = await systemTools.get_registered_helper(service["id"])
+            expressions = self.service_schedule(userData, service, helperConfig)
+            if expressions is None or helperConfig["boot_run"]:
                 continue
-            
 
-            helperConfig = await systemTools.get_registered_helper(helper["id"])
-            if not helperConfig or helperConfig["disabled"] or helperConfig["internal"]:
-                self.logger.warn(f"[QUEUE] Helper {helper['id']} is not available. Skipping scheduling for user {user_id}.")
-                continue
-            
-            if userData["region"] not in helperConfig["region_lock"] and helperConfig["region_lock"] != ["*"]:
-                self.logger.warn(f"[QUEUE] Helper {helper['id']} is not available in user {user_id} region ({userData["region"]}). Skipping scheduling.")
-                continue
-            if helperConfig["admin_only"] and not userData["admin"]:
-                self.logger.warn(f"[QUEUE] Helper {helper['id']} is admin-only. Skipping scheduling for non-admin user {user_id}.")
-                continue
+            nextRun = self.next_run_time(service["id"], expressions, currentTime)
+            if nextRun is not None:
+                nextRuns[self.schedule_member(user_id, service["id"])] = nextRun
 
-            if helperConfig["boot_run"]:
-                continue
-            
-            if helperConfig["allow_execution_time_config"]:
-                scheduleExpressions = helper["schedule"]
+        await self.flush_schedule([], nextRuns)
+        await self.extend_schedules(currentTime, members=list(nextRuns))
+
+    async def reschedule_helper(self, helper_id: str):
+        # cancels a helper's jobs and re-creates them with the new config. besides its current entries, the internal entry or the
+        # users that enabled it are seeded too, so added helpers get scheduled. entries that no longer apply are dropped by the extension.
+        # the entries are marked due before anything is cancelled, so if we fail halfway the next extension tick re-creates the jobs
+        # the change can reach us before the registry invalidation does
+        await systemTools.load_registry()
+        helperConfig = await systemTools.get_registered_helper(helper_id)
+
+        members = {member async for member, _ in redisClient.zscan_iter("scheduleNextRuns", match=f"*:{helper_id}")}
+        if helperConfig and not helperConfig["disabled"]:
+            if helperConfig["internal"]:
+                members.add(self.schedule_member("internal", helper_id))
             else:
-                scheduleExpressions = helperConfig["schedule"]
+                users = await authTools.get_active_users_with_services([helper_id])
+                members.update(self.schedule_member(user["id"], helper_id) for user in users)
 
-            for expression in scheduleExpressions:
-                try:
-                    timestamps = systemTools.cron_to_timestamps(expression, currentTime, lookahedTime)
-                    for ts in timestamps:
-                        await self.queue_job(
-                            helper_id=helper["id"],
-                            user_id=user_id,
-                            execution_time=ts,
-                            priority=helperConfig["priority"],
-                            execution_expiry=helperConfig["timeout"],
-                        )
-                except Exception as e:
-                    self.logger.error(f"[QUEUE] Invalid cron expression '{expression}' for helper {helper['id']}. Skipping.", e)
-        
-    async def get_jobs_to_run(self, time: int):
-        jobs = await redisClient.zrangebyscore("internalExecutionQueue", "-inf", time * 10)
-        valid_jobs = []
-        for job in jobs:
-            job_details = await self.get_job_details(job)
-            if job_details["status"] == "queued":
-                valid_jobs.append(job)
-        return valid_jobs
-        
-    async def get_job_details(self, execution_id: str):
-        return await redisClient.hgetall(f"executionJob:{execution_id}")
-    
-    async def update_job_status(self, id: str, status: str):
-        await redisClient.hset(f"executionJob:{id}", "status", status)
-    
-    async def clear_queue(self):
-        keys = await redisClient.keys("executionJob:*")
-        if keys:
-            await redisClient.delete(*keys)
-        await redisClient.delete("internalExecutionQueue")
+        if members:
+            await self.write_schedule({member: 0 for member in members})
+        cancelledJobs = await self.cancel_helper_jobs(helper_id)
+        if members:
+            await self.extend_schedules(int(datetime.datetime.now().timestamp()), members=list(members))
+        self.logger.info(f"[QUEUE] Helper {helper_id} changed. Cancelled {cancelledJobs} jobs, rescheduling {len(members)} entries.")
 
-    async def build_initial_execution_queue(self):
+    async def build_initial_execution_queue(self, warm: bool = False):
+        # only seeds every entry's next run time. the jobs themselves are queued by extend_schedules as entries become due.
+        # on a warm restart the persisted schedule index is kept and only boot runs are queued
         self.logger.info("[QUEUE] Building initial execution queue...")
-        activeUsers = await authTools.get_all_active_users()
         allHelpers = await systemTools.get_all_helpers()
+        seedSchedules = not warm or not await redisClient.exists("scheduleNextRuns")
+        if seedSchedules:
+            self.lastChangeId = None
+            activeUsers = await authTools.get_all_active_users()
+        else:
+            self.lastChangeId = await redisClient.get("schedulingChanges:lastId")
+            bootRunHelpers = [helper["id"] for helper in allHelpers if helper["boot_run"] and not helper["internal"]]
+            activeUsers = await authTools.get_active_users_with_services(bootRunHelpers) if bootRunHelpers else []
+            self.logger.info(f"[QUEUE] Warm restart: resuming persisted schedules, queueing boot runs for {len(activeUsers)} users.")
+        if self.lastChangeId is None:
+            # changes made while we build are picked up by the realtime updater afterwards
+            lastEntry = await redisClient.xrevrange(SCHEDULING_CHANGES_STREAM, count=1)
+            self.lastChangeId = lastEntry[0][0] if lastEntry else "0-0"
         currentTime = int(datetime.datetime.now().timestamp())
-        lookahedTime = currentTime + 2 * 3600  # 2h
+        startedAt = time.perf_counter()
+        pendingJobs = []
+        nextRuns = {}
+        seededEntries = 0
         
         for helper in allHelpers:
             if helper["internal"] == True and not helper["disabled"]:
 
                 if helper["boot_run"]:
                     self.logger.info(f"[QUEUE] Scheduling boot_run for internal helper {helper['id']}.")
-                    await self.queue_job(
+                    pendingJobs.append(self.build_job(
                         helper_id=helper["id"],
                         user_id="internal",
                         execution_time=int(datetime.datetime.now().timestamp()),
                         priority=helper.get("priority", 3),
-                        execution_expiry=helper.get("timeout", 3600),
-                    )
-                
-                for expression in helper["schedule"]:
-                    try:
-                        timestamps = systemTools.cron_to_timestamps(expression, currentTime, lookahedTime)
-                        for ts in timestamps:
-                            await self.queue_job(
-                                helper_id=helper["id"],
-                                user_id="internal",
-                                execution_time=ts,
-                                priority=helper.get("priority", 3),
-                                execution_expiry=helper.get("timeout", 3600),
-                            )
+                        execution_expiry=self.execution_expiry(helper),
+                        region=self.job_region(helper),
+                    ))
 
-                            self.logger.info(f"[QUEUE] Scheduled internal helper {helper['id']} at {ts}.")
-                    except Exception as e:
-                        self.logger.error(f"[QUEUE] Invalid cron expression '{expression}' for internal helper {helper['id']}. Skipping.", e)
+                nextRun = self.next_run_time(helper["id"], helper["schedule"], currentTime) if seedSchedules else None
+                if nextRun is not None:
+                    nextRuns[self.schedule_member("internal", helper["id"])] = nextRun
 
         self.logger.info("[QUEUE] Done processing internal helpers. Processing user helpers...")
 
-        for user in activeUsers:
-            try:
-                self.logger.info(f"[QUEUE] Processing user {user['id']}...")
-                userHelpers = user["services"]
-                for helper in userHelpers:
-                    self.logger.info(f"[QUEUE] Processing helper {helper['id']} for user {user['id']}...")
-                    if not helper["enabled"]:
-                        self.logger.info(f"[QUEUE] Helper {helper['id']} is disabled for user {user['id']}. Skipping.")
-                        continue
-                    helperConfig = await systemTools.get_registered_helper(helper["id"])
-                    if not helperConfig or helperConfig["disabled"] or helperConfig["internal"]:
-                        self.logger.warn(f"[QUEUE] Helper {helper['id']} is not available. Skipping scheduling for user {user['id']}.")
-                        continue
-                    
-                    if user["region"] not in helperConfig["region_lock"] and helperConfig["region_lock"] != ["*"]:
-                        self.logger.warn(f"[QUEUE] Helper {helper['id']} is not available in user {user['id']} region ({user['region']}). Skipping scheduling.")
-                        continue
-
-                    if helperConfig["admin_only"] and not user["admin"]:
-                        self.logger.warn(f"[QUEUE] Helper {helper['id']} is admin-only. Skipping scheduling for non-admin user {user['id']}.")
-                        continue
-
-                    if helperConfig["boot_run"]:
-                        self.logger.info(f"[QUEUE] Scheduling boot_run for helper {helper['id']} for user {user['id']}.")
-                        await self.queue_job(
-                            helper_id=helper["id"],
-                            user_id=user["id"],
-                            execution_time=int(datetime.datetime.now().timestamp()), # repeat bc currentTime maybe be older
-                            priority=helperConfig.get("priority", 3),
-                            execution_expiry=helperConfig.get("timeout", 3600),
-                        )
-                        continue
-                    
-                    if helperConfig["allow_execution_time_config"]:
-                        scheduleExpressions = helper["schedule"]
-                    else:
-                        scheduleExpressions = helperConfig["schedule"]
-
-                    for expression in scheduleExpressions:
-                        try:
-                            timestamps = systemTools.cron_to_timestamps(expression, currentTime, lookahedTime)
-                            for ts in timestamps:
-                                await self.queue_job(
-                                    helper_id=helper["id"],
-                                    user_id=user["id"],
-                                    execution_time=ts,
-                                    priority=helperConfig["priority"],
-                                    execution_expiry=helperConfig["timeout"],
-                                )
-                        except Exception as e:
-                            self.logger.error(f"[QUEUE] Invalid cron expression '{expression}' for helper {helper['id']}. Skipping.", e)
-            except Exception as e:
-                self.logger.error(f"[QUEUE] Error processing user {user['id']}. Skipping", e)
+        await self.flush_schedule(pendingJobs, nextRuns)
+        seededEntries += len(nextRuns)
+        helperConfigs = {helper["id"]: helper for helper in allHelpers}
+
+        async def seed_users(users):
+            pendingJobs = []
+            nextRuns = {}
+            for user in users:
+                try:
+                    for service in user["services"]:
+                        helperConfig = helperConfigs.get(service["id"])
+                        expressions = self.service_schedule(user, service, helperConfig)
+                        if expressions is None:
+                            continue
+
+                        if helperConfig["boot_run"]:
+                            self.logger.info(f"[QUEUE] Scheduling boot_run for helper {service['id']} for user {user['id']}.")
+                            pendingJobs.append(self.build_job(
+                                helper_id=service["id"],
+                                user_id=user["id"],
+                                execution_time=int(datetime.datetime.now().timestamp()), # repeat bc currentTime maybe be older
+                                priority=helperConfig.get("priority", 3),
+                                execution_expiry=self.execution_expiry(helperConfig),
+                                region=self.job_region(helperConfig, user),
+                            ))
+                            continue
+
+                        if not seedSchedules:
+                            continue
+
+                        nextRun = self.next_run_time(service["id"], expressions, currentTime)
+                        if nextRun is not None:
+                            nextRuns[self.schedule_member(user["id"], service["id"])] = nextRun
+                except Exception as e:
+                    self.logger.error(f"[QUEUE] Error processing user {user['id']}. Skipping", e)
+
+            await self.flush_schedule(pendingJobs, nextRuns)
+            return len(nextRuns)
+
+        seededEntries += sum(await self.run_chunks(activeUsers, seed_users))
+        self.logger.info(f"[QUEUE] Seeded {seededEntries} schedules in {time.perf_counter() - startedAt:.2f}s.")
+
+        queuedJobs = await self.extend_schedules(currentTime)
+        await self.write_schedule(lastChangeId=self.lastChangeId)
+        elapsed = time.perf_counter() - startedAt
+        self.logger.info(f"[QUEUE] Finished building initial execution queue. Queued {queuedJobs} jobs in {elapsed:.2f}s ({queuedJobs / max(elapsed, 1e-6):.0f} jobs/s).")
+        self.logger.info(f"[QUEUE] Cron expansion cache: {systemTools.cron_cache_stats()}")
+
+    async def extend_schedules(self, currentTime: int, members: list = None):
+        # queues every entry whose next run is due soon up to the horizon, then advances its next run past it.
+        # entries that fire rarely are only touched when they are about to fire
+        horizonEnd = currentTime + self.scheduleHorizon
+        queuedJobs = 0
+        helperConfigs = {}
+
+        async def helper_config(helperId):
+            if helperId not in helperConfigs:
+                helperConfigs[helperId] = await systemTools.get_registered_helper(helperId)
+            return helperConfigs[helperId]
 
-        self.logger.info("[QUEUE] Finished building initial execution queue.")
-    
-    async def queue_updater_realtime(self):
-        self.logger.info("[REALTIME QUEUE] Starting real-time queue updater...")
         while True:
-            try:
-                currentTime = int(datetime.datetime.now().timestamp())
-                lookAhead = currentTime + 10 * 60  # 10m
-                allHelpers = await systemTools.get_all_helpers()
-                activeUsers = await authTools.get_all_active_users()
+            if members is None:
+                dueEntries = await redisClient.zrangebyscore(
+                    "scheduleNextRuns", "-inf", currentTime + self.scheduleRefill,
+                    start=0, num=self.batchSize, withscores=True,
+                )
+            else:
+                scores = await redisClient.zmscore("scheduleNextRuns", members) if members else []
+                dueEntries = [(member, score) for member, score in zip(members, scores) if score is not None and score <= horizonEnd]
+            if not dueEntries:
+                break
+
+            entriesByUser = {}
+            for member, nextRun in dueEntries:
+                userId, helperId = member.split(":", 1)
+                entriesByUser.setdefault(userId, []).append((helperId, max(int(nextRun), currentTime)))
 
-                for user in activeUsers:
+            async def extend_users(userIds):
+                try:
+                    users = await authTools.get_users_by_ids([userId for userId in userIds if userId != "internal"])
+                except Exception as e:
+                    self.logger.error(f"[REALTIME QUEUE] Error loading {len(userIds)} users. Skipping them.", e)
+                    return 0, len(userIds)
+                pendingJobs = []
+                nextRuns = {}
+                removedEntries = []
+                failedUsers = 0
+
+                for userId in userIds:
                     try:
-                        self.logger.info(f"[REALTIME QUEUE] Processing user {user['id']}...")
-                        userHelpers = user["services"]
-                        for helper in userHelpers:
-                            self.logger.info(f"[REALTIME QUEUE] Processing helper {helper['id']} for user {user['id']}...")
-                            if not helper["enabled"]:
-                                self.logger.info(f"[REALTIME QUEUE] Helper {helper['id']} is disabled for user {user['id']}. Skipping.")
-                                continue
-                            helperConfig = await systemTools.get_registered_helper(helper["id"])
+                        user = users.get(userId)
+                        for helperId, nextRun in entriesByUser[userId]:
+                            member = self.schedule_member(userId, helperId)
+                            helperConfig = await helper_config(helperId)
 
-                            if helperConfig["boot_run"]:
-                                continue
-                            
-                            if user["region"] not in helperConfig["region_lock"] and helperConfig["region_lock"] != ["*"]:
-                                self.logger.warn(f"[REALTIME QUEUE] Helper {helper['id']} is not available in user {user['id']} region ({user['region']}). Skipping scheduling.")
-                                continue
+                            if userId == "internal":
+                                expressions = helperConfig["schedule"] if helperConfig and not helperConfig["disabled"] else None
+                            elif not user or user.get("status") != "active":
+                                expressions = None
+                            else:
+                                service = next((s for s in user["services"] if s["id"] == helperId), {})
+                                expressions = self.service_schedule(user, service, helperConfig, tag="[REALTIME QUEUE]")
+                                if expressions is not None and helperConfig["boot_run"]:
+                                    expressions = None
 
-                            if not helperConfig or helperConfig["disabled"] or helperConfig["internal"]:
-                                self.logger.warn(f"[REALTIME QUEUE] Helper {helper['id']} is not available. Skipping scheduling for user {user['id']}.")
+                            upcomingRun = self.next_run_time(helperId, expressions, horizonEnd) if expressions else None
+                            if upcomingRun is None:
+                                removedEntries.append(member)
                                 continue
 
-                            if helperConfig["admin_only"] and not user["admin"]:
-                                self.logger.warn(f"[REALTIME QUEUE] Helper {helper['id']} is admin-only. Skipping scheduling for non-admin user {user['id']}.")
-                                continue
+                            # nextRun itself is due, so the window starts right before it
+                            pendingJobs += self.build_scheduled_jobs(
+                                helperId, userId, expressions, helperConfig, nextRun - 1, horizonEnd, region=self.job_region(helperConfig, user),
+                            )
+                            nextRuns[member] = upcomingRun
+                    except Exception as e:
+                        # entries are left as they are so the next tick retries them
+                        self.logger.error(f"[REALTIME QUEUE] Error extending schedule for user {userId}. Skipping.", e)
+                        failedUsers += 1
 
-                            if helperConfig["allow_execution_time_config"]:
-                                schedule_expressions = helper["schedule"]
-                            else:
-                                schedule_expressions = helperConfig["schedule"]
-
-                            for expression in schedule_expressions:
-
-                                try:
-                                    timestamps = systemTools.cron_to_timestamps(expression, currentTime, lookAhead)
-                                    for ts in timestamps:
-                                        # Check if the job is already scheduled
-                                        existingJobs = await self.get_jobs_to_run(lookAhead)
-                                        
-
-                                        jobAlreadyScheduled = False
-                                        for job in existingJobs:
-                                            jobDetails = await self.get_job_details(job)
-                                            if jobDetails.get("helperId") == helper["id"] and jobDetails.get("userId") == user["id"] and int(jobDetails.get("executionTime")) == int(ts):
-                                                self.logger.info(f"[REALTIME QUEUE] Job for helper {helper['id']} and user {user['id']} at {ts} already scheduled. Skipping.")
-                                                jobAlreadyScheduled = True
-                                                break
-
-                                        if not jobAlreadyScheduled:
-                                            # Schedule the job if not already scheduled
-                                            await self.queue_job(
-                                                helper_id=helper["id"],
-                                                user_id=user["id"],
-                                                execution_time=ts,
-                                                priority=helperConfig.get("priority", 3),
-                                                execution_expiry=helperConfig.get("timeout", 3600),
-                                            )
-                                            self.logger.info(f"[REALTIME QUEUE] Scheduled job for helper {helper['id']} and user {user['id']} at {ts}.")
-                                except Exception as e:
-                                    self.logger.error(f"[REALTIME QUEUE] Invalid cron expression '{expression}' for helper {helper['id']}. Skipping.", e)
+                return await self.flush_schedule(pendingJobs, nextRuns, removedEntries), failedUsers
+
+            results = await self.run_chunks(list(entriesByUser), extend_users)
+            queuedJobs += sum(queued for queued, _ in results)
+            failedUsers = sum(failed for _, failed in results)
+            if members is not None or failedUsers or len(dueEntries) < self.batchSize:
+                break
+
+        return queuedJobs
+
+    async def consume_scheduling_changes(self, block_ms: int):
+        if self.lastChangeId is None:
+            # a new leader resumes where the previous one stopped
+            self.lastChangeId = await redisClient.get("schedulingChanges:lastId")
+        if self.lastChangeId is None:
+            lastEntry = await redisClient.xrevrange(SCHEDULING_CHANGES_STREAM, count=1)
+            self.lastChangeId = lastEntry[0][0] if lastEntry else "0-0"
+
+        streams = await redisClient.xread({SCHEDULING_CHANGES_STREAM: self.lastChangeId}, count=self.batchSize, block=block_ms)
+        # the cursor only moves past changes that were applied. a failing change stops the batch and is retried on the next read,
+        # until it has failed CHANGE_MAX_ATTEMPTS times in a row and is skipped
+        appliedChanges = set()
+        failed = False
+        for _, entries in streams or []:
+            for entryId, change in entries:
+                changeKey = ("helper", change["helperId"]) if change.get("helperId") else ("user", change.get("userId"))
+                if changeKey[1] and changeKey not in appliedChanges:
+                    try:
+                        if changeKey[0] == "helper":
+                            await self.reschedule_helper(changeKey[1])
+                        else:
+                            await self.update_queue_for_user(changeKey[1])
+                    except LeadershipLost:
+                        raise
                     except Exception as e:
-                        self.logger.error(f"[REALTIME QUEUE] Error processing user {user['id']}. Skipping.", e)
-                
-                self.logger.info(f"[REALTIME QUEUE] Done processing user helpers. Processing internal helpers...")
-
-                for helper in allHelpers:
-                    if helper["internal"] == True and not helper["disabled"]:
-                        self.logger.info(f"[REALTIME QUEUE] Processing internal helper {helper['id']}...")
-                        for expression in helper["schedule"]:
-                            try:
-                                timestamps = systemTools.cron_to_timestamps(expression, currentTime, lookAhead)
-                                existingJobs = await self.get_jobs_to_run(lookAhead)
-                                for ts in timestamps:
-                                    # Check if the job is already scheduled
-                                    jobAlreadyScheduled = False
-                                    for job in existingJobs:
-                                        jobDetails = await self.get_job_details(job)
-                                        if jobDetails.get("helperId") == helper["id"] and int(jobDetails.get("executionTime")) == int(ts) and jobDetails.get("userId") == "internal":
-                                            self.logger.info(f"[REALTIME QUEUE] Job for internal helper {helper['id']} at {ts} already scheduled. Skipping.")
-                                            jobAlreadyScheduled = True
-                                            break
-                                    
-                                    if not jobAlreadyScheduled:
-                                        # Schedule the job if not already scheduled
-                                        await self.queue_job(
-                                            helper_id=helper["id"],
-                                            user_id="internal",
-                                            execution_time=ts,
-                                            priority=helper.get("priority", 3),
-                                            execution_expiry=helper.get("timeout", 3600),
-                                        )
-                                        self.logger.info(f"[REALTIME QUEUE] Scheduled job for internal helper {helper['id']} at {ts}.")
-                            except Exception as e:
-                                self.logger.error(f"[REALTIME QUEUE] Invalid cron expression '{expression}' for internal helper {helper['id']}. Skipping.", e)
-                
-                self.logger.info("[REALTIME QUEUE] Done processing internal helpers.")
-                self.logger.info("[REALTIME QUEUE] Expanded execution queue by 10 minutes.")
-                await asyncio.sleep(600)  # Run every 10 minutes
+                        attempts = self.changeFailures.get(entryId, 0) + 1
+                        if attempts < CHANGE_MAX_ATTEMPTS:
+                            self.logger.error(f"[REALTIME QUEUE] Error rescheduling {changeKey[0]} {changeKey[1]} (attempt {attempts}). Retrying.", e)
+                            self.changeFailures = {entryId: attempts}
+                            failed = True
+                            break
+                        self.logger.error(f"[REALTIME QUEUE] Error rescheduling {changeKey[0]} {changeKey[1]} after {attempts} attempts. Skipping.", e)
+                    self.changeFailures = {}
+                    appliedChanges.add(changeKey)
+                self.lastChangeId = entryId
+            if failed:
+                break
+
+        if appliedChanges:
+            # persisted so a warm restart (or the next leader) resumes the feed where we left it
+            await self.write_schedule(lastChangeId=self.lastChangeId)
+        if failed:
+            await asyncio.sleep(1)
+        return len(appliedChanges)
+    
+    async def queue_updater_realtime(self):
+        # reacts to user/helper changes as they happen and queues schedules that are about to fire
+        self.logger.info("[REALTIME QUEUE] Starting real-time queue updater...")
+        nextExtension = 0
+        while True:
+            try:
+                currentTime = time.time()
+                if currentTime >= nextExtension:
+                    startedAt = time.perf_counter()
+                    queuedJobs = await self.extend_schedules(int(currentTime))
+                    nextExtension = currentTime + self.scheduleTick
+                    if queuedJobs:
+                        self.logger.info(f"[REALTIME QUEUE] Queued {queuedJobs} upcoming jobs in {time.perf_counter() - startedAt:.2f}s.")
+
+                blockFor = max(1, int((nextExtension - time.time()) * 1000))
+                changes = await self.consume_scheduling_changes(blockFor)
+                if changes:
+                    self.logger.info(f"[REALTIME QUEUE] Rescheduled {changes} changed users/helpers.")
+            except LeadershipLost as e:
+                self.logger.warn(f"[REALTIME QUEUE] Stopping, another instance took over. {e}")
+                return
             except Exception as e:
                 self.logger.error("[REALTIME QUEUE] Error in real-time queue updater.", e)
+                await asyncio.sleep(1)
+
+    async def run_scheduler(self, fencing_token: str):
+        # leader-only. an instance that takes over mid-flight resumes the persisted schedules and change feed,
+        # the schedule index is only rebuilt if no leader finished building it (the feed position is written last)
+        self.fencingToken = fencing_token
+        self.lastChangeId = None
+        if not await redisClient.exists("schedulingChanges:lastId"):
+            await self.build_initial_execution_queue(warm=True)
+        await self.queue_updater_realtime()
@@ -1,6 +1,12 @@
 import os
+import signal
+import socket
+import hashlib
 import importlib
-from bases.helper import BaseHelper
+import importlib.util
+import sys
+import time
+from bases.helper import BaseHelper, HelperDeferred
 import asyncio
 import datetime
 import json
@@ -8,70 +14,451 @@ from utils.logger import Logger
 from utils.systemTools import SystemTools
 from api.utils.authTools import AuthenticationTools
 from utils.queueTools import QueueTools
+from utils.executor import executor, HelperTimeout, HelperExpired
+from api.utils.redis import redisClient
 
 systemTools = SystemTools()
 authTools = AuthenticationTools()
 
+# the last boots of every instance, newest first
+STARTUP_METRICS_KEY = "startupMetrics"
+STARTUP_METRICS_HISTORY = 100
+
 
 class Startup:
 
     def __init__(self, logger: Logger):
         self.queueTools = QueueTools(logger)
         self.logger = logger
+        self.claimLimit = int(os.environ.get("DISPATCHER_CLAIM_LIMIT", 100))
+        self.maxIdle = float(os.environ.get("DISPATCHER_MAX_IDLE", 60))
+        self.wakeupEvent = asyncio.Event()
+        self.wakeupListener = None
+        self.workerId = os.environ.get("WORKER_ID", f"{socket.gethostname()}:{os.getpid()}")
+        self.leaseSeconds = int(os.environ.get("JOB_LEASE_SECONDS", 60))
+        self.inFlightJobs = {}
+        # comma separated queue shards this worker dispatches, empty means every shard
+        self.stopRequested = asyncio.Event()
+        self.shutdownGrace = int(os.environ.get("SHUTDOWN_GRACE_SECONDS", 30))
+        self.apiProcess = None
+        self.shards = [shard.strip() for shard in os.environ.get("DISPATCHER_SHARDS", "").split(",") if shard.strip()] or None
+        self.manifestPath = os.environ.get("HELPER_MANIFEST_PATH", os.path.join("data", "helperManifest.json"))
+        self.discoveryStats = {}
+        self.helperFiles = {}  # file -> manifest entry of what this process has loaded
+        self.reloadInterval = float(os.environ.get("HELPERS_RELOAD_INTERVAL_SECONDS", 2))
 
    
 
-    async def discover_helpers(self):
-        helperFiles = [file for file in os.listdir("helpers") if file.endswith('.py')]
+    def hash_file(self, path: str):
+        with open(path, "rb") as file:
+            return hashlib.sha256(file.read()).hexdigest()
+
+    def fingerprint_helper_file(self, file: str, cachedEntry: dict = None):
+        # the hash is only recomputed when mtime or size moved, so an untouched tree costs one stat per file
+        stat = os.stat(os.path.join("helpers", file))
+        if cachedEntry and cachedEntry["mtime"] == stat.st_mtime_ns and cachedEntry["size"] == stat.st_size:
+            return {"mtime": stat.st_mtime_ns, "size": stat.st_size, "hash": cachedEntry["hash"]}
+        return {"mtime": stat.st_mtime_ns, "size": stat.st_size, "hash": self.hash_file(os.path.join("helpers", file))}
+
+    def import_helper_file(self, file: str):
+        try:
+            return importlib.import_module(f"helpers.{file[:-3]}")
+        except Exception as e:
+            return e
+
+    def inspect_helper_module(self, file: str, helperModule):
+        # returns the manifest entries of the valid helpers defined in the module, and the problems of the others
+        entries, problems = [], []
+        for attr in dir(helperModule):
+            obj = getattr(helperModule, attr)
+            # classes imported from other modules are picked up in their own file
+            if not (isinstance(obj, type) and issubclass(obj, BaseHelper) and obj is not BaseHelper and obj.__module__ == helperModule.__name__):
+                continue
+            try:
+                instance = obj()
+                initArgs = json.loads(json.dumps(dict(instance.__dict__)))
+            except Exception as e:
+                problems.append(f"Unable to load helper {attr} on file {file}. Please check helper configuration!\n{e}")
+                continue
+
+            helperProblems = systemTools.validate_helper(instance)
+            if instance.id in [entry["id"] for entry in entries]:
+                helperProblems.append(f"id {instance.id} is already used in this file")
+            if helperProblems:
+                problems.append(f"[STARTUP] Skipping helper {attr} on file {file}: {'; '.join(helperProblems)}.")
+                continue
+            entries.append({"id": instance.id, "module": helperModule.__name__, "className": attr, "initArgs": initArgs})
+        return entries, problems
+
+    def read_manifest(self):
+        try:
+            with open(self.manifestPath, encoding="utf-8") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            self.logger.warn(f"[STARTUP] Ignoring unreadable helper manifest {self.manifestPath}. {e}")
+            return {}
+
+    def write_manifest(self, manifest: dict):
+        # written next to the old one and swapped in, so instances sharing the file never read half of it
+        try:
+            os.makedirs(os.path.dirname(self.manifestPath) or ".", exist_ok=True)
+            temporaryPath = f"{self.manifestPath}.{os.getpid()}.tmp"
+            with open(temporaryPath, "w", encoding="utf-8") as file:
+                json.dump(manifest, file)
+            os.replace(temporaryPath, self.manifestPath)
+        except Exception as e:
+            self.logger.warn(f"[STARTUP] Unable to write helper manifest {self.manifestPath}. {e}")
+
+    def owns_helper_id(self, entry: dict):
+        # a helper id belongs to the first file defining it. a file may take over its own ids when it is reloaded
+        source = systemTools.helper_source(entry["id"])
+        return source is None or source[0] == entry["module"]
+
+    async def load_helper_classes(self):
+        # helper files that didn't change since the manifest was written are loaded from it and only imported on first dispatch.
+        # changed files are imported in parallel, validated and written back to the manifest. returns the init args of every loaded helper
+        startedAt = time.perf_counter()
+        manifest = self.read_manifest()
+        # the base class decides the defaults every helper is registered with, so changing it invalidates the whole manifest
+        baseHash = await asyncio.to_thread(self.hash_file, os.path.join("bases", "helper.py"))
+        cachedFiles = manifest.get("files", {}) if manifest.get("base") == baseHash else {}
+
+        helperFiles = sorted(file for file in os.listdir("helpers") if file.endswith('.py'))
+        fingerprints = await asyncio.gather(*(asyncio.to_thread(self.fingerprint_helper_file, file, cachedFiles.get(file)) for file in helperFiles))
+        changedFiles = [file for file, fingerprint in zip(helperFiles, fingerprints) if cachedFiles.get(file, {}).get("hash") != fingerprint["hash"]]
+        importedModules = dict(zip(changedFiles, await asyncio.gather(*(asyncio.to_thread(self.import_helper_file, file) for file in changedFiles))))
+
+        inspectedFiles = {}
+        for file, helperModule in importedModules.items():
+            if isinstance(helperModule, Exception):
+                # not written to the manifest, so it is imported again on the next boot
+                self.logger.warn(f"Unable to import helper on file {file}. Please check helper configuration!\n{helperModule}")
+            else:
+                inspectedFiles[file] = self.inspect_helper_module(file, helperModule)
+
+        files = {}
         loadedHelpers = []
+        for file, fingerprint in zip(helperFiles, fingerprints):
+            if file in inspectedFiles:
+                entries, problems = inspectedFiles[file]
+            elif file in cachedFiles and file not in importedModules:
+                entries, problems = cachedFiles[file]["helpers"], cachedFiles[file]["problems"]
+            else:
+                continue
+            files[file] = {**fingerprint, "helpers": entries, "problems": problems}
 
-        for file in helperFiles:
+            for problem in problems:
+                self.logger.warn(problem)
+            for entry in entries:
+                if not self.owns_helper_id(entry):
+                    self.logger.warn(f"[STARTUP] Skipping helper {entry['className']} on file {file}: id {entry['id']} is already used by {'.'.join(systemTools.helper_source(entry['id']))}.")
+                    continue
+                if file in importedModules:
+                    systemTools.register_helper_class(entry["id"], getattr(importedModules[file], entry["className"]))
+                else:
+                    systemTools.register_lazy_helper(entry["id"], entry["module"], entry["className"])
+                loadedHelpers.append(entry["initArgs"])
+
+        self.baseHash = baseHash
+        self.helperFiles = files
+        if manifest != {"base": baseHash, "files": files}:
+            await asyncio.to_thread(self.write_manifest, {"base": baseHash, "files": files})
+
+        self.discoveryStats = {
+            "helperFiles": len(helperFiles),
+            "cachedFiles": len(helperFiles) - len(changedFiles),
+            "importedFiles": len(changedFiles),
+            "helpers": len(loadedHelpers),
+            "loadSeconds": round(time.perf_counter() - startedAt, 4),
+        }
+        return loadedHelpers
+
+    async def discover_helpers(self):
+        helpers = await self.load_helper_classes()
+        startedAt = time.perf_counter()
+        try:
+            await systemTools.register_helpers({helper["id"]: json.dumps(helper) for helper in helpers})
+        except Exception as e:
+            self.logger.error("[STARTUP] Unable to register helpers", e)
+            return []
+
+        loadedHelpers = []
+        for helper in helpers:
             try:
-                helper = importlib.import_module(f"helpers.{file[:-3]}")
-                for attr in dir(helper):
-                    obj = getattr(helper, attr)
-                    if isinstance(obj, type) and issubclass(obj, BaseHelper) and obj is not BaseHelper:
-                        instance = obj()
-                        init_args = dict(instance.__dict__)
-                        await systemTools.register_helper(instance.id, json.dumps(init_args))
-                        loadedHelpers.append(instance.id)
-                        self.logger.info(f"[STARTUP] Loaded helper: {instance.name} with ID: {instance.id}")
+                if helper["disabled"]:
+                    cancelledJobs = await self.queueTools.cancel_helper_jobs(helper["id"])
+                    self.logger.info(f"[STARTUP] Helper {helper['id']} is disabled. Cancelled {cancelledJobs} queued jobs.")
+                loadedHelpers.append(helper["id"])
+                self.logger.info(f"[STARTUP] Loaded helper: {helper['name']} with ID: {helper['id']}")
             except Exception as e:
-                self.logger.warn(f"Unable to import helper on file {file}. Please check helper configuration!\n{e}")
+                self.logger.warn(f"Unable to register helper {helper['id']}. Please check helper configuration!\n{e}")
 
+        self.discoveryStats["registerSeconds"] = round(time.perf_counter() - startedAt, 4)
         return loadedHelpers
 
-        
-    async def run_dispatcher(self):
+    def import_helper_file_isolated(self, file: str):
+        # executes a fresh copy of the module without touching sys.modules, so a broken edit leaves the loaded version running
+        spec = importlib.util.spec_from_file_location(f"helpers.{file[:-3]}", os.path.join("helpers", file))
+        helperModule = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(helperModule)
+        return helperModule
+
+    async def reload_helper_file(self, file: str, fingerprint: dict, register: bool = True):
+        # swaps in every helper of a changed (or new) file at once, or none of them if any fails to load or validate
+        previousEntry = self.helperFiles.get(file, {})
+        previousIds = {entry["id"] for entry in previousEntry.get("helpers", [])}
+        try:
+            helperModule = await asyncio.to_thread(self.import_helper_file_isolated, file)
+            entries, problems = self.inspect_helper_module(file, helperModule)
+            problems += [
+                f"[RELOAD] Helper {entry['className']} on file {file} uses id {entry['id']}, which is already used by {'.'.join(systemTools.helper_source(entry['id']))}."
+                for entry in entries if not self.owns_helper_id(entry)
+            ]
+        except Exception as e:
+            entries, problems = [], [f"Unable to import helper on file {file}. Please check helper configuration!\n{e}"]
+        if problems:
+            for problem in problems:
+                self.logger.warn(problem)
+            self.logger.warn(f"[RELOAD] Keeping the previously loaded version of {file}.")
+            # remembered so the same content isn't retried on every poll, but left out of the manifest
+            self.helperFiles[file] = {**previousEntry, **fingerprint, "stale": True}
+            return []
+
+        entryIds = {entry["id"] for entry in entries}
+        removedIds = [helperId for helperId in previousIds - entryIds if self.owns_helper_id({"id": helperId, "module": helperModule.__name__})]
+        sys.modules[helperModule.__name__] = helperModule
+        for entry in entries:
+            systemTools.register_helper_class(entry["id"], getattr(helperModule, entry["className"]))
+        for helperId in removedIds:
+            systemTools.unregister_helper_class(helperId)
+        self.helperFiles[file] = {**fingerprint, "helpers": entries, "problems": []}
+
+        changedHelpers = []
+        if register:
+            # changed and removed helpers are announced by the registry itself, added ones are announced here
+            changedHelpers = await systemTools.register_helpers(
+                {entry["id"]: json.dumps(entry["initArgs"]) for entry in entries}, removedIds,
+            )
+            await systemTools.notify_helper_changes([helperId for helperId in entryIds - previousIds if helperId in changedHelpers])
+        self.logger.info(f"[RELOAD] Reloaded {file}: {len(entries)} helpers loaded, {len(removedIds)} removed, {len(changedHelpers)} changed.")
+        return changedHelpers
+
+    async def unload_helper_file(self, file: str, register: bool = True):
+        removedIds = [entry["id"] for entry in self.helperFiles.pop(file, {}).get("helpers", []) if self.owns_helper_id(entry)]
+        for helperId in removedIds:
+            systemTools.unregister_helper_class(helperId)
+        if register:
+            await systemTools.register_helpers({}, removedIds)
+        self.logger.info(f"[RELOAD] Removed {file}: unloaded {len(removedIds)} helpers.")
+
+    async def watch_helpers(self, register: bool = True):
+        # polls the helpers folder and hot reloads the files that changed. only the affected helpers are rescheduled (by the queue
+        # updater leader), the rest of the queue is left alone. register is False on dispatch-only workers, which only swap classes
+        self.logger.info(f"[RELOAD] Watching helpers for changes every {self.reloadInterval}s.")
         while True:
+            await asyncio.sleep(self.reloadInterval)
             try:
+                helperFiles = sorted(file for file in os.listdir("helpers") if file.endswith('.py'))
+                fingerprints = await asyncio.gather(*(asyncio.to_thread(self.fingerprint_helper_file, file, self.helperFiles.get(file)) for file in helperFiles))
+                reloaded = False
+                for file, fingerprint in zip(helperFiles, fingerprints):
+                    knownEntry = self.helperFiles.get(file, {})
+                    if knownEntry.get("hash") == fingerprint["hash"]:
+                        if knownEntry.get("mtime") != fingerprint["mtime"]:
+                            # touched but not changed
+                            knownEntry.update(fingerprint)
+                        continue
+                    await self.reload_helper_file(file, fingerprint, register)
+                    reloaded = True
+                for file in set(self.helperFiles) - set(helperFiles):
+                    await self.unload_helper_file(file, register)
+                    reloaded = True
+
+                if reloaded:
+                    files = {file: entry for file, entry in self.helperFiles.items() if not entry.get("stale")}
+                    await asyncio.to_thread(self.write_manifest, {"base": self.baseHash, "files": files})
+            except Exception as e:
+                self.logger.error("[RELOAD] Error while reloading helpers", e)
+
+    async def record_startup_metrics(self, metrics: dict):
+        # kept in redis so cold start times can be compared across deploys and instances
+        metrics = {"workerId": self.workerId, "startedAt": int(time.time()), **self.discoveryStats, **metrics}
+        self.logger.info(f"[STARTUP] Startup metrics: {metrics}")
+        try:
+            async with redisClient.pipeline(transaction=True) as pipe:
+                pipe.lpush(STARTUP_METRICS_KEY, json.dumps(metrics))
+                pipe.ltrim(STARTUP_METRICS_KEY, 0, STARTUP_METRICS_HISTORY - 1)
+                await pipe.execute()
+        except Exception as e:
+            self.logger.error("[STARTUP] Unable to record startup metrics", e)
+
+    async def run_dispatcher(self):
+        self.wakeupListener = asyncio.create_task(self.queueTools.listen_for_wakeups(self.wakeupEvent, self.shards))
+        while not self.stopRequested.is_set():
+            try:
+                # leave due jobs in the queue for other workers while our executor is saturated
+                await executor.wait_for_capacity()
+                claimLimit = min(self.claimLimit, executor.available_slots())
+
+                shards = self.shards or await self.queueTools.get_shards()
                 currentTime = int(datetime.datetime.now().timestamp())
-                jobs = await self.queueTools.get_jobs_to_run(currentTime)
+                # claimed jobs are already marked as running and removed from the queue
+                # helpers at their local cap are left queued for other workers instead of piling up here
+                jobs = await self.queueTools.claim_due_jobs(currentTime, claimLimit, self.workerId, currentTime + self.leaseSeconds, shards, executor.helper_room())
 
-                for job in jobs:
-                    self.logger.info(f"[DISPATCHER] Processing job {job}...")
+                for jobData in jobs:
+                    jobId = jobData.get("executionId")
+                    self.logger.info(f"[DISPATCHER] Processing job {jobId}...")
                     try:
-                        jobData = await self.queueTools.get_job_details(job)
-                        executionTime = int(jobData.get("executionTime", 0))
+                        # a retry is due at its retryAt, its expiry counts from there
+                        executionTime = int(jobData.get("retryAt") or jobData.get("executionTime", 0))
                         executionExpiry = int(jobData.get("executionExpiry", 0))
                         userId = jobData.get("userId")
                         helperId = jobData.get("helperId")
-                        jobId = job
 
                         if currentTime > executionTime + executionExpiry:
-                            await self.queueTools.update_job_status(jobId, "expired")
+                            await self.queueTools.complete_job(jobId, self.workerId, "expired")
                         else:
-                            await self.queueTools.update_job_status(jobId, "running")
                             userData = await authTools.get_user_by_id(userId)
-                            await systemTools.run_helper(helperId, userData)
+                            helperTask = await systemTools.run_helper(helperId, userData, executionTime + executionExpiry)
+                            self.inFlightJobs[jobId] = asyncio.create_task(self.watch_job(jobData, helperTask))
                             self.logger.info(f"[DISPATCHER] Dispatched job {jobId} for execution.")
 
                     except Exception as e:
                         self.logger.error(f"[DISPATCHER] Error processing job {jobId}", e)
-                await asyncio.sleep(1)
+                        await self.queueTools.fail_job(jobData, self.workerId, repr(e))
+
+                if len(jobs) < claimLimit:
+                    # sleeps until the queue head is due, or until an earlier job is queued
+                    await self.queueTools.wait_for_next_job(self.wakeupEvent, self.maxIdle, shards, self.queueTools.quotaBlocked)
             except Exception as e:
                 self.logger.error("[DISPATCHER] Error in dispatcher loop", e)
 
+    async def watch_job(self, jobData, helperTask):
+        jobId = jobData.get("executionId")
+        error = None
+        try:
+            await helperTask
+        except asyncio.CancelledError:
+            # shutting down, the job is released back to the queue
+            self.inFlightJobs.pop(jobId, None)
+            raise
+        except HelperTimeout as e:
+            self.logger.warn(f"[DISPATCHER] Job {jobId} timed out. {e}")
+            error = e
+        except HelperExpired as e:
+            self.logger.warn(f"[DISPATCHER] Job {jobId} expired before it could start. {e}")
+            error = e
+        except HelperDeferred as e:
+            self.logger.info(f"[DISPATCHER] Job {jobId} deferred by {e.delay}s.")
+            error = e
+        except Exception as e:
+            self.logger.error(f"[DISPATCHER] Job {jobId} failed", e)
+            error = e
+
+        try:
+            if error is None:
+                await self.queueTools.complete_job(jobId, self.workerId, "completed")
+            elif isinstance(error, HelperTimeout):
+                # runaway helpers are not retried
+                await self.queueTools.complete_job(jobId, self.workerId, "timed_out")
+            elif isinstance(error, HelperExpired):
+                await self.queueTools.complete_job(jobId, self.workerId, "expired")
+            elif isinstance(error, HelperDeferred):
+                await self.queueTools.defer_job(jobData, self.workerId, int(datetime.datetime.now().timestamp()) + max(1, int(error.delay)))
+            else:
+                # retried with backoff, or dead-lettered once it runs out of attempts
+                await self.queueTools.fail_job(jobData, self.workerId, repr(error))
+        except Exception as e:
+            self.logger.error(f"[DISPATCHER] Unable to finish job {jobId}", e)
+        finally:
+            self.inFlightJobs.pop(jobId, None)
+
+    async def run_heartbeat(self):
+        # renews leases of our in-flight jobs and re-queues jobs of workers that stopped renewing theirs
+        while True:
+            try:
+                currentTime = int(datetime.datetime.now().timestamp())
+                await redisClient.set(f"dispatcherWorker:{self.workerId}", currentTime, ex=self.leaseSeconds)
+
+                lostJobs = await self.queueTools.renew_leases(self.workerId, list(self.inFlightJobs), currentTime + self.leaseSeconds)
+                for jobId in lostJobs:
+                    self.logger.warn(f"[HEARTBEAT] Lost lease on job {jobId}. It may run again on another worker.")
+
+                requeuedJobs = await self.queueTools.requeue_expired_leases(currentTime)
+                if requeuedJobs:
+                    self.logger.warn(f"[HEARTBEAT] Re-queued {requeuedJobs} jobs with expired leases.")
+
+                self.logger.debug(f"[EXECUTOR] {executor.stats()}")
+            except Exception as e:
+                self.logger.error("[HEARTBEAT] Error in heartbeat loop", e)
+            await asyncio.sleep(self.leaseSeconds / 3)
+
+
+    def install_signal_handlers(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.request_shutdown)
+
+    def request_shutdown(self):
+        if self.stopRequested.is_set():
+            self.logger.warn("[SHUTDOWN] Received a second shutdown signal. Skipping the drain.")
+            self.force_exit(self.apiProcess)
+        self.logger.info("[SHUTDOWN] Shutdown requested.")
+        self.stopRequested.set()
+
+    async def run_until_shutdown(self, dispatcherTask, backgroundTasks: list):
+        # runs until a shutdown signal arrives or one of the tasks crashes, then drains
+        stopTask = asyncio.create_task(self.stopRequested.wait())
+        done, _ = await asyncio.wait([dispatcherTask, *backgroundTasks, stopTask], return_when=asyncio.FIRST_COMPLETED)
+        exitCode = 0
+        for task in done:
+            if task is not stopTask and not task.cancelled() and task.exception():
+                self.logger.error("[STARTUP] Shutting down due to internal error", task.exception())
+                exitCode = 1
+
+        try:
+            await self.shutdown(dispatcherTask, backgroundTasks)
+        except Exception as e:
+            self.logger.error("[SHUTDOWN] Graceful shutdown failed", e)
+            self.force_exit(self.apiProcess)
+        return exitCode
+
+    async def shutdown(self, dispatcherTask, backgroundTasks: list):
+        # stop claiming first. the heartbeat keeps renewing our leases while in-flight jobs drain
+        self.stopRequested.set()
+        for task in (dispatcherTask, self.wakeupListener):
+            if task:
+                task.cancel()
+        if self.apiProcess and self.apiProcess.returncode is None:
+            self.apiProcess.terminate()
+
+        self.logger.info(f"[SHUTDOWN] Waiting up to {self.shutdownGrace}s for {len(self.inFlightJobs)} in-flight jobs...")
+        if self.inFlightJobs:
+            await asyncio.wait(list(self.inFlightJobs.values()), timeout=self.shutdownGrace)
+
+        unfinishedJobs = len(self.inFlightJobs)
+        for task in list(self.inFlightJobs.values()):
+            task.cancel()
+        await executor.shutdown()
+        releasedJobs = await self.queueTools.release_worker_jobs(self.workerId)
+        self.logger.info(f"[SHUTDOWN] {unfinishedJobs} jobs didn't finish in time. Released {releasedJobs} claimed jobs back to the queue.")
+
+        for task in backgroundTasks:
+            task.cancel()
+        await asyncio.gather(dispatcherTask, *backgroundTasks, return_exceptions=True)
+        await redisClient.delete(f"dispatcherWorker:{self.workerId}")
+
+        if self.apiProcess:
+            try:
+                await asyncio.wait_for(self.apiProcess.wait(), timeout=10)
+            except TimeoutError:
+                self.apiProcess.kill()
+
+        self.logger.info("[SHUTDOWN] Shutdown complete.")
+        self.logger.close()
 
     def force_exit(self, apiProcess):
             self.logger.info("[SHUTDOWN] Killing all tasks...")
@@ -1,51 +1,258 @@
-from api.utils.redis import redisClient
+from api.utils.redis import redisClient, SCHEDULING_CHANGES_STREAM
 import croniter
 import datetime
 import asyncio
+import importlib
 import json
+import os
+import re
+import time
+from collections import OrderedDict
+from utils.executor import executor, EXECUTION_MODES
+
+CRON_CACHE_SIZE = int(os.environ.get("CRON_CACHE_SIZE", 4096))
+STEP_MINUTES_EXPRESSION = re.compile(r"^(\*|\*/(\d+))\s+\*\s+\*\s+\*\s+\*$")
+
+# shared by every SystemTools instance in the process
+cronExpansions = OrderedDict()  # (expression, timezone, start, end) -> timestamps
+compiledCrons = {}  # expression -> ("step", minutes) or ("croniter", parsed croniter)
+cronCacheStats = {"hits": 0, "misses": 0}
+
+# the registry is a single hash (helper id -> json), so listing it is one HGETALL
+REGISTRY_KEY = "internalAvailableHelpers"
+
+# in-process snapshot of the helper registry, redis stays the source of truth.
+# every registry change bumps the version in redis and is announced on the channel, which drops the snapshot so the next read reloads it.
+# entries are shared, callers must not mutate them
+REGISTRY_VERSION_KEY = "helperRegistryVersion"
+REGISTRY_CHANNEL = "helperRegistry:invalidate"
+REGISTRY_CHECK_SECONDS = int(os.environ.get("HELPER_REGISTRY_CHECK_SECONDS", 30))
+helperRegistry = {"version": None, "helpers": {}}  # version None means the snapshot must be reloaded
+registryListener = {"task": None}
+
+# helper id -> helper class, built once when helpers are discovered so dispatching doesn't import anything
+helperClasses = {}
+# helper id -> (module name, class name) for helpers registered from the discovery manifest, imported on first dispatch
+lazyHelperClasses = {}
+
 
 class SystemTools:
 
-    async def register_helper(self, helper_id: str, helper_value: dict):
-        await redisClient.set(f"internalAvailableHelpers:{helper_id}", helper_value)
+    async def register_helpers(self, helpers: dict, removed_helpers: list = []):
+        # helper id -> json value. registers (and removes) the whole set in one transaction and returns the helpers that changed
+        if not helpers and not removed_helpers:
+            return []
+        helperIds = list(helpers)
+        async with redisClient.pipeline(transaction=True) as pipe:
+            pipe.hmget(REGISTRY_KEY, helperIds + list(removed_helpers))
+            if helpers:
+                pipe.hset(REGISTRY_KEY, mapping=helpers)
+            if removed_helpers:
+                pipe.hdel(REGISTRY_KEY, *removed_helpers)
+            previousValues = (await pipe.execute())[0]
+
+        changedHelpers = [helperId for helperId, previousValue in zip(helperIds, previousValues) if previousValue != helpers[helperId]]
+        updatedHelpers = [helperId for helperId, previousValue in zip(helperIds, previousValues) if previousValue is not None and previousValue != helpers[helperId]]
+        removedHelpers = [helperId for helperId, previousValue in zip(removed_helpers, previousValues[len(helperIds):]) if previousValue is not None]
+        if changedHelpers or removedHelpers:
+            await self.bump_registry_version()
+        await self.notify_helper_changes(updatedHelpers + removedHelpers)
+        return changedHelpers + removedHelpers
+
+    async def notify_helper_changes(self, helper_ids: list):
+        # the queue updater leader reschedules the jobs of these helpers
+        if not helper_ids:
+            return
+        async with redisClient.pipeline(transaction=False) as pipe:
+            for helperId in helper_ids:
+                pipe.xadd(SCHEDULING_CHANGES_STREAM, {"helperId": helperId}, maxlen=10000, approximate=True)
+            await pipe.execute()
     
+    async def unregister_helper(self, helper_id: str):
+        await redisClient.hdel(REGISTRY_KEY, helper_id)
+        await self.bump_registry_version()
+
     async def get_registered_helper(self, helper_id: str):
-        redisResult = await redisClient.get(f"internalAvailableHelpers:{helper_id}")
-        if not redisResult:
-            return None
-        return json.loads(redisResult)
+        await self.ensure_registry()
+        return helperRegistry["helpers"].get(helper_id)
     
     async def clear_helpers(self):
-        keys = await redisClient.keys("internalAvailableHelpers:*")
-        for key in keys:
-            await redisClient.delete(key)
+        await redisClient.unlink(REGISTRY_KEY)
+        await self.bump_registry_version()
 
     async def get_all_helpers(self):
-        keys = await redisClient.keys("internalAvailableHelpers:*")
-        helpers = []
-        for key in keys:
-            helperData = await redisClient.get(key)
-            if helperData:
-                helpers.append(json.loads(helperData))
-        return helpers
+        await self.ensure_registry()
+        return list(helperRegistry["helpers"].values())
+
+    async def bump_registry_version(self):
+        version = await redisClient.incr(REGISTRY_VERSION_KEY)
+        helperRegistry["version"] = None
+        await redisClient.publish(REGISTRY_CHANNEL, version)
+
+    async def load_registry(self):
+        # version and helpers are read atomically, so the snapshot always matches its version
+        async with redisClient.pipeline(transaction=True) as pipe:
+            pipe.get(REGISTRY_VERSION_KEY)
+            pipe.hgetall(REGISTRY_KEY)
+            version, helpers = await pipe.execute()
+        helperRegistry["helpers"] = {helperId: json.loads(value) for helperId, value in helpers.items()}
+        helperRegistry["version"] = version or "0"
+
+    async def ensure_registry(self):
+        if registryListener["task"] is None or registryListener["task"].done():
+            registryListener["task"] = asyncio.create_task(self.listen_for_registry_changes())
+        if helperRegistry["version"] is None:
+            await self.load_registry()
+
+    async def listen_for_registry_changes(self):
+        while True:
+            try:
+                # closed before we resubscribe, so every retry doesn't leak a connection
+                async with redisClient.pubsub() as pubsub:
+                    await pubsub.subscribe(REGISTRY_CHANNEL)
+                    # changes announced before we (re)subscribed are caught by reloading once
+                    helperRegistry["version"] = None
+                    while True:
+                        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=REGISTRY_CHECK_SECONDS)
+                        if message is not None:
+                            if message["data"] != helperRegistry["version"]:
+                                helperRegistry["version"] = None
+                        elif helperRegistry["version"] is not None and (await redisClient.get(REGISTRY_VERSION_KEY) or "0") != helperRegistry["version"]:
+                            # a missed message is caught by the periodic version check
+                            helperRegistry["version"] = None
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                await asyncio.sleep(1)
     
     def cron_to_timestamps(self, expression, start, end):
-        base = datetime.datetime.fromtimestamp(start)
-        cron = croniter.croniter(expression, base)
+        # every user sharing an expression in the same pass gets the same (cached) expansion
+        cacheKey = (expression, time.tzname, int(start), int(end))
+        if cacheKey in cronExpansions:
+            cronCacheStats["hits"] += 1
+            cronExpansions.move_to_end(cacheKey)
+            return cronExpansions[cacheKey]
+
+        cronCacheStats["misses"] += 1
+        times = tuple(self.expand_cron(expression, start, end))
+        cronExpansions[cacheKey] = times
+        if len(cronExpansions) > CRON_CACHE_SIZE:
+            cronExpansions.popitem(last=False)
+        return times
+
+    def next_fire_time(self, expression, after):
+        cacheKey = (expression, time.tzname, int(after), None)
+        if cacheKey in cronExpansions:
+            cronCacheStats["hits"] += 1
+            cronExpansions.move_to_end(cacheKey)
+            return cronExpansions[cacheKey]
+
+        cronCacheStats["misses"] += 1
+        kind, compiled = self.compile_cron(expression)
+        if kind == "step":
+            nextTime = self.expand_cron(expression, after, after + compiled * 60)[0]
+        else:
+            compiled.set_current(datetime.datetime.fromtimestamp(after), force=True)
+            nextTime = int(compiled.get_next(datetime.datetime).timestamp())
+
+        cronExpansions[cacheKey] = nextTime
+        if len(cronExpansions) > CRON_CACHE_SIZE:
+            cronExpansions.popitem(last=False)
+        return nextTime
+
+    def compile_cron(self, expression):
+        if expression not in compiledCrons:
+            stepMatch = STEP_MINUTES_EXPRESSION.match(expression.strip())
+            stepMinutes = int(stepMatch.group(2) or 1) if stepMatch else None
+            if stepMinutes and 60 % stepMinutes == 0:
+                compiledCrons[expression] = ("step", stepMinutes)
+            else:
+                compiledCrons[expression] = ("croniter", croniter.croniter(expression, datetime.datetime.now()))
+        return compiledCrons[expression]
+
+    def expand_cron(self, expression, start, end):
+        kind, compiled = self.compile_cron(expression)
+
+        if kind == "step":
+            # "*/N * * * *" fires on every local minute divisible by N, no need to walk a croniter
+            startOffset = datetime.datetime.fromtimestamp(start).astimezone().utcoffset()
+            endOffset = datetime.datetime.fromtimestamp(end).astimezone().utcoffset()
+            if startOffset == endOffset:
+                offsetMinutes = int(startOffset.total_seconds()) // 60
+                minute = int(start) // 60 + 1
+                minute += (-(minute + offsetMinutes)) % compiled
+                return range(minute * 60, int(end) + 1, compiled * 60)
+            compiled = croniter.croniter(expression, datetime.datetime.now())
+
+        compiled.set_current(datetime.datetime.fromtimestamp(start), force=True)
         times = []
 
         while True:
-            nextTime = cron.get_next(datetime.datetime)
+            nextTime = compiled.get_next(datetime.datetime)
             if nextTime.timestamp() > end:
                 break
 
             times.append(int(nextTime.timestamp()))
         
         return times
+
+    def cron_cache_stats(self):
+        return {**cronCacheStats, "size": len(cronExpansions), "compiled": len(compiledCrons)}
         
-    async def run_helper(self, helperId, userData):
-        helperModule = __import__(f"helpers.{helperId}", fromlist=[helperId])
-        helper = getattr(helperModule, helperId)(user=userData)
+    def validate_helper(self, helper):
+        # checked once at discovery, so dispatch can trust the metadata
+        problems = []
+        if not isinstance(helper.id, str) or not helper.id:
+            problems.append("id must be a non-empty string")
+        if not isinstance(helper.priority, int) or not 1 <= helper.priority <= 5:
+            problems.append("priority must be an integer from 1 to 5")
+        if helper.timeout is not None and (not isinstance(helper.timeout, (int, float)) or helper.timeout <= 0):
+            problems.append("timeout must be a positive number")
+        if helper.execution_expiry is not None and (not isinstance(helper.execution_expiry, int) or helper.execution_expiry < 1):
+            problems.append("execution_expiry must be a positive integer")
+        for attribute in ("max_concurrency", "max_attempts"):
+            value = getattr(helper, attribute)
+            if value is not None and (not isinstance(value, int) or value < 1):
+                problems.append(f"{attribute} must be a positive integer")
+        if helper.execution_mode not in EXECUTION_MODES:
+            problems.append(f"execution_mode must be one of {', '.join(EXECUTION_MODES)}")
+        if not isinstance(helper.schedule, list) or any(not croniter.croniter.is_valid(expression) for expression in helper.schedule):
+            problems.append("schedule must be a list of valid cron expressions")
+        if not isinstance(helper.region_lock, list):
+            problems.append("region_lock must be a list")
+        if not asyncio.iscoroutinefunction(helper.run):
+            problems.append("run must be an async method")
+        return problems
+
+    def register_helper_class(self, helper_id: str, helper_class: type):
+        helperClasses[helper_id] = helper_class
+        lazyHelperClasses.pop(helper_id, None)
+
+    def register_lazy_helper(self, helper_id: str, module_name: str, class_name: str):
+        helperClasses.pop(helper_id, None)
+        lazyHelperClasses[helper_id] = (module_name, class_name)
+
+    def unregister_helper_class(self, helper_id: str):
+        helperClasses.pop(helper_id, None)
+        lazyHelperClasses.pop(helper_id, None)
+
+    def helper_source(self, helper_id: str):
+        if helper_id in helperClasses:
+            return (helperClasses[helper_id].__module__, helperClasses[helper_id].__name__)
+        return lazyHelperClasses.get(helper_id)
+
+    def create_helper(self, helper_id: str, user_data: dict):
+        helperClass = helperClasses.get(helper_id)
+        if helperClass is None and helper_id in lazyHelperClasses:
+            moduleName, className = lazyHelperClasses[helper_id]
+            helperClass = getattr(importlib.import_module(moduleName), className)
+            self.register_helper_class(helper_id, helperClass)
+        if helperClass is None:
+            raise ValueError(f"Helper {helper_id} was not discovered by this process")
+        return helperClass(user=user_data)
 
-        asyncio.create_task(helper.run())
-        return
\ No newline at end of file
+    async def run_helper(self, helperId, userData, expires_at: float = None):
+        if helperId in lazyHelperClasses:
+            # the first dispatch of a helper registered from the manifest imports its module off the event loop
+            await asyncio.to_thread(importlib.import_module, lazyHelperClasses[helperId][0])
+        return executor.submit(self.create_helper(helperId, userData), expires_at)
\ No newline at end of file